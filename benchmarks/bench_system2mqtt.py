@@ -0,0 +1,656 @@
+"""Offline benchmarks and load tests for system2mqtt.py.
+
+Run from the repository root:
+
+    python benchmarks/bench_system2mqtt.py                # every benchmark
+    python benchmarks/bench_system2mqtt.py --quick        # smaller sizes, fewer repeats
+    python benchmarks/bench_system2mqtt.py scaling broker # selected benchmarks
+    python benchmarks/bench_system2mqtt.py --output bench_output.txt
+
+Nothing here touches the real system or network: psutil is replaced by
+FakePsutil, systemctl by a generated script put first on PATH, /proc, hwmon
+and cgroup trees by generated directories, and the MQTT broker by
+InProcessBroker. Sizes are chosen so regressions in publish_states and
+_generate_discovery_payload show up as configurations grow.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator
+
+import psutil
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import system2mqtt  # noqa: E402
+from system2mqtt import (  # noqa: E402
+    HUB_SLICES, CgroupCollector, HighFrequencySampler, HwmonIndex, ProcBackend, ProcessTable,
+    PsutilBackend, SystemMonitor, dump_json,
+)
+
+DiskUsage = namedtuple("DiskUsage", "total used free percent")
+NetIO = namedtuple("NetIO", "bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout")
+DiskIO = namedtuple("DiskIO", "read_count write_count read_bytes write_bytes read_time write_time")
+CpuTimes = namedtuple("CpuTimes", "user nice system idle iowait irq softirq steal guest guest_nice")
+VirtualMemory = namedtuple("VirtualMemory", "total available percent used free")
+
+
+class FakePsutil:
+    """Stand-in for the psutil module with N synthetic mountpoints, interfaces and block devices.
+
+    disk_usage can be made slow (delay seconds per call) or hung (blocks
+    until release() is called) to exercise collector deadlines. Anything not
+    simulated falls through to the real psutil.
+    """
+
+    def __init__(self, interfaces: list | None = None, block_devices: list | None = None, delay: float = 0.0, hang: bool = False) -> None:
+        self.interfaces = interfaces or []
+        self.block_devices = block_devices or []
+        self.delay = delay
+        self.hang = hang
+        self.released = threading.Event()
+        self.calls = 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(psutil, name)
+
+    def release(self) -> None:
+        self.released.set()
+
+    def _tick(self) -> int:
+        self.calls += 1
+        return self.calls
+
+    def disk_usage(self, path: str) -> DiskUsage:
+        if self.hang:
+            self.released.wait()
+        elif self.delay:
+            time.sleep(self.delay)
+        total = 500 * 1024**3
+        used = (100 + len(path)) * 1024**3
+        return DiskUsage(total, used, total - used, round(used / total * 100, 1))
+
+    def net_io_counters(self, pernic: bool = False) -> Dict[str, NetIO]:
+        tick = self._tick()
+        return {
+            iface: NetIO(tick * 1_000_000 + index, tick * 2_000_000 + index, tick, tick, 0, 0, 0, 0)
+            for index, iface in enumerate(self.interfaces)
+        }
+
+    def disk_io_counters(self, perdisk: bool = False) -> Dict[str, DiskIO]:
+        tick = self._tick()
+        return {device: DiskIO(tick * 10, tick * 20, tick * 4096, tick * 8192, 0, 0) for device in self.block_devices}
+
+    def cpu_times(self) -> CpuTimes:
+        tick = self._tick()
+        return CpuTimes(tick * 3.0, 0.0, tick * 1.0, tick * 6.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def virtual_memory(self) -> VirtualMemory:
+        total = 16 * 1024**3
+        return VirtualMemory(total, total // 2, 50.0, total // 2, total // 4)
+
+    def boot_time(self) -> float:
+        return time.time() - 86400
+
+    def sensors_temperatures(self) -> Dict[str, list]:
+        return {}
+
+
+@contextmanager
+def fake_psutil(fake: FakePsutil) -> Iterator[FakePsutil]:
+    real = system2mqtt.psutil
+    system2mqtt.psutil = fake
+    try:
+        yield fake
+    finally:
+        fake.release()
+        system2mqtt.psutil = real
+
+
+@contextmanager
+def fake_systemctl(directory: Path, delay: float = 0.0) -> Iterator[None]:
+    """Put a systemctl on PATH that answers `show` and `is-active` for any unit name."""
+    script = directory / "systemctl"
+    script.write_text(f"""#!{sys.executable}
+import sys, time
+time.sleep({delay})
+args = sys.argv[1:]
+if args[0] == "is-active":
+    print("active")
+    sys.exit(0)
+units = args[args.index("--") + 1:]
+blocks = []
+for index, unit in enumerate(units):
+    state = "failed" if index % 7 == 3 else "active"
+    blocks.append(f"ActiveState={{state}}\\nSubState={{'running' if state == 'active' else 'failed'}}\\nNRestarts={{index % 3}}\\nMainPID={{1000 + index}}\\nMemoryCurrent={{(index + 1) * 1048576}}")
+print("\\n\\n".join(blocks))
+""")
+    script.chmod(0o755)
+    path = os.environ.get("PATH", "")
+    os.environ["PATH"] = f"{directory}{os.pathsep}{path}"
+    try:
+        yield
+    finally:
+        os.environ["PATH"] = path
+
+
+class MessageInfo:
+    def __init__(self, mid: int) -> None:
+        self.mid = mid
+        self.rc = 0
+
+
+class InProcessBroker:
+    """Records every published message; QoS 1 messages are acknowledged after ack_delay on a separate thread."""
+
+    def __init__(self, ack_delay: float = 0.0) -> None:
+        self.ack_delay = ack_delay
+        self.messages = 0
+        self.bytes = 0
+        self.retained: Dict[str, bytes] = {}
+        self.last_payloads: Dict[str, bytes] = {}
+        self.latencies: list[float] = []
+        self.pending: list[tuple[float, float, Callable[[], None]]] = []
+        self.lock = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._acknowledge, name="broker", daemon=True)
+        self.thread.start()
+
+    def receive(self, topic: str, payload: Any, qos: int, retain: bool, on_ack: Callable[[], None]) -> None:
+        data = payload.encode() if isinstance(payload, str) else bytes(payload or b"")
+        now = time.perf_counter()
+        with self.lock:
+            self.messages += 1
+            self.bytes += len(data)
+            self.last_payloads[topic] = data
+            if retain:
+                self.retained[topic] = data
+            if qos == 0:
+                # paho reports QoS 0 messages as soon as they are written to the socket
+                self.latencies.append(0.0)
+            else:
+                self.pending.append((now + self.ack_delay, now, on_ack))
+                self.lock.notify()
+                return
+        on_ack()
+
+    def _acknowledge(self) -> None:
+        while True:
+            with self.lock:
+                while not self.pending and not self.stopped:
+                    self.lock.wait()
+                if self.stopped:
+                    return
+                due, sent, on_ack = self.pending[0]
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    self.lock.wait(delay)
+                    continue
+                self.pending.pop(0)
+                self.latencies.append(time.perf_counter() - sent)
+            on_ack()
+
+    def drain(self, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def stop(self) -> None:
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+
+
+class BrokerClient:
+    """The part of paho's Client that SystemMonitor uses, wired to an InProcessBroker."""
+
+    def __init__(self, broker: InProcessBroker) -> None:
+        self.broker = broker
+        self.on_publish: Callable[[Any, Any, int], None] | None = None
+        self.next_mid = 0
+        self.lock = threading.Lock()
+
+    def publish(self, topic: str, payload: Any = None, qos: int = 0, retain: bool = False) -> MessageInfo:
+        with self.lock:
+            self.next_mid = self.next_mid % 65535 + 1
+            mid = self.next_mid
+        message = MessageInfo(mid)
+        self.broker.receive(topic, payload, qos, retain, lambda: self.on_publish and self.on_publish(self, None, mid))
+        return message
+
+    def subscribe(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+
+def make_monitor(workdir: Path, broker: InProcessBroker, **kwargs: Any) -> SystemMonitor:
+    kwargs.setdefault("backend", "psutil")
+    monitor = SystemMonitor("localhost", 1883, "", "", state_file=str(workdir / "state.json"), **kwargs)
+    monitor.client = BrokerClient(broker)
+    monitor.client.on_publish = monitor.on_publish
+    monitor.publisher.client = monitor.client
+    monitor.connected.set()
+    return monitor
+
+
+def close_monitor(monitor: SystemMonitor) -> None:
+    monitor.executor.shutdown(wait=False, cancel_futures=True)
+    if monitor.sampler:
+        monitor.sampler.stop()
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    """Median wall time of func in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def peak_allocation(func: Callable[[], Any]) -> int:
+    """Peak bytes allocated by one call of func on top of what was live before it."""
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        return peak - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:.2f}"
+
+
+def us(seconds: float) -> str:
+    return f"{seconds * 1e6:.1f}"
+
+
+def kib(size: int) -> str:
+    return f"{size / 1024:.1f}"
+
+
+class Report:
+    def __init__(self, output: Any = None) -> None:
+        self.output = output
+
+    def write(self, line: str = "") -> None:
+        print(line, flush=True)
+        if self.output:
+            self.output.write(line + "\n")
+
+    def table(self, title: str, header: list[str], rows: list[list[Any]]) -> None:
+        widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+        self.write(f"== {title}")
+        self.write("  ".join(str(cell).rjust(width) for cell, width in zip(header, widths)))
+        for row in rows:
+            self.write("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+        self.write()
+
+
+def write_proc_root(root: Path, interfaces: int, block_devices: int = 4, processes: int = 0) -> Path:
+    """A /proc stand-in with the files ProcBackend, ProcessTable and psutil (via PROCFS_PATH) read."""
+    (root / "net").mkdir(parents=True, exist_ok=True)
+    (root / "stat").write_text("cpu  4705 356 584 3699 23 23 0 0 0 0\ncpu0 4705 356 584 3699 23 23 0 0 0 0\nintr 0\nctxt 0\nbtime 1700000000\n")
+    meminfo = {"MemTotal": 16318460, "MemFree": 8062272, "MemAvailable": 12212172, "Buffers": 282552, "Cached": 3781760,
+               "SwapCached": 0, "Active": 4190236, "Inactive": 2940676, "SwapTotal": 0, "SwapFree": 0, "Shmem": 281240,
+               "Slab": 512000, "SReclaimable": 403120}
+    (root / "meminfo").write_text("".join(f"{key}:{value:>16} kB\n" for key, value in meminfo.items()))
+    (root / "uptime").write_text("86400.12 172000.50\n")
+    lines = [
+        "Inter-|   Receive                                                |  Transmit",
+        " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed",
+    ]
+    lines += [f"{f'veth{index}':>8}: {index * 1000 + 5} 10 0 0 0 0 0 0 {index * 2000 + 7} 20 0 0 0 0 0 0" for index in range(interfaces)]
+    (root / "net" / "dev").write_text("\n".join(lines) + "\n")
+    (root / "diskstats").write_text("".join(f"   8      {index * 16:>3} sd{chr(97 + index)} 100 0 2000 50 200 0 4000 80 0 100 130\n" for index in range(block_devices)))
+    for pid in range(1, processes + 1):
+        directory = root / str(pid)
+        directory.mkdir(exist_ok=True)
+        fields = ["S", "1", str(pid), str(pid), "0", "-1", "4194560", "100", "0", "0", "0", str(pid * 3), str(pid), "0", "0", "20", "0", "1", "0", str(1000 + pid), "1000000", "250"]
+        (directory / "stat").write_text(f"{pid} (worker {pid % 50}) {' '.join(fields)}\n")
+        (directory / "statm").write_text(f"2000 {250 + pid % 1000} 100 10 0 200 0\n")
+        (directory / "cmdline").write_bytes(f"/usr/bin/worker\0--id\0{pid}\0".encode())
+    return root
+
+
+def write_hwmon_root(root: Path, chips: int, inputs_per_chip: int) -> Path:
+    for chip in range(chips):
+        directory = root / f"hwmon{chip}"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "name").write_text("coretemp\n" if chip == 0 else f"chip{chip}\n")
+        for number in range(1, inputs_per_chip + 1):
+            kind = "temp" if number % 2 else "fan"
+            (directory / f"{kind}{number}_input").write_text(f"{40000 + number * 100}\n")
+            (directory / f"{kind}{number}_label").write_text(f"Sensor {number}\n")
+    return root
+
+
+def write_cgroup_root(root: Path, count: int) -> Path:
+    for index in range(count):
+        directory = root / "system.slice" / f"docker-{index:04x}.scope"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "cpu.stat").write_text(f"usage_usec {index * 1000}\nuser_usec 0\nsystem_usec 0\n")
+        (directory / "memory.current").write_text(f"{index * 1048576}\n")
+        (directory / "io.stat").write_text(f"8:0 rbytes={index * 4096} wbytes={index * 8192} rios=1 wios=2 dbytes=0 dios=0\n")
+        (directory / "pids.current").write_text("3\n")
+    return root
+
+
+def bench_scaling(report: Report, workdir: Path, quick: bool) -> None:
+    """Startup, discovery and cycle cost as mountpoints, interfaces and services grow together."""
+    sizes = [1, 10, 100] if quick else [1, 10, 100, 500, 1000]
+    repeat = 3 if quick else 10
+    rows = []
+    for size in sizes:
+        directory = workdir / f"scaling-{size}"
+        directory.mkdir()
+        interfaces = [f"veth{index}" for index in range(size)]
+        fake = FakePsutil(interfaces=interfaces)
+        broker = InProcessBroker()
+        with fake_psutil(fake), fake_systemctl(directory):
+            config = {
+                "mountpoints": [f"/mnt/volume{index}" for index in range(size)],
+                "interfaces": interfaces,
+                "services": [f"unit{index}.service" for index in range(size)],
+            }
+            start = time.perf_counter()
+            monitor = make_monitor(directory, broker, **config)
+            startup = time.perf_counter() - start
+            discovery_time = measure(monitor._generate_discovery_payload, repeat)
+            discovery_bytes = len(dump_json(monitor.discovery_payload))
+            monitor.publish_discovery()
+
+            cycle = measure(lambda: monitor.publish_states(force=True), repeat)
+            allocation = peak_allocation(lambda: monitor.publish_states(force=True))
+            payload_bytes = len(broker.last_payloads[monitor.state_topic])
+            slowest = max(monitor.metrics.collector_wall.items(), key=lambda item: item[1])
+            fields = sum(len(state) for state in monitor.collector_states.values())
+            close_monitor(monitor)
+        broker.stop()
+        rows.append([size, fields, ms(startup), ms(discovery_time), kib(discovery_bytes), ms(cycle), f"{slowest[0]} {ms(slowest[1])}", kib(allocation), kib(payload_bytes)])
+    report.table(
+        "Scaling with N mountpoints + N interfaces + N services (psutil fakes, systemctl stand-in)",
+        ["N", "fields", "startup ms", "discovery ms", "discovery KiB", "cycle ms", "slowest collector ms", "cycle peak KiB", "payload KiB"],
+        rows,
+    )
+
+
+def bench_publish_modes(report: Report, workdir: Path, quick: bool) -> None:
+    """Publish cost and bytes on the wire for full vs change-only publishing at a fixed size."""
+    size = 100 if quick else 500
+    cycles = 5 if quick else 20
+    rows = []
+    for mode in ("full", "changes"):
+        directory = workdir / f"mode-{mode}"
+        directory.mkdir()
+        interfaces = [f"veth{index}" for index in range(size)]
+        broker = InProcessBroker()
+        with fake_psutil(FakePsutil(interfaces=interfaces)):
+            monitor = make_monitor(directory, broker, mountpoints=[f"/mnt/volume{index}" for index in range(size)], interfaces=interfaces, publish_mode=mode, deadbands={"net_upload": (10.0, True), "net_download": (10.0, True)})
+            monitor.publish_discovery()
+            messages, sent = broker.messages, broker.bytes
+            cycle = measure(lambda: monitor.publish_states(force=True), cycles)
+            close_monitor(monitor)
+        broker.stop()
+        rows.append([mode, size, cycles, ms(cycle), broker.messages - messages, kib(broker.bytes - sent)])
+    report.table("Full vs change-only publishing", ["mode", "N", "cycles", "cycle ms", "messages", "KiB sent"], rows)
+
+
+def bench_services(report: Report, workdir: Path, quick: bool) -> None:
+    """Batched systemctl show against unit count, including process spawn cost."""
+    counts = [1, 10, 100] if quick else [1, 10, 100, 500]
+    rows = []
+    directory = workdir / "services"
+    directory.mkdir()
+    broker = InProcessBroker()
+    with fake_psutil(FakePsutil()), fake_systemctl(directory):
+        for count in counts:
+            monitor = make_monitor(directory, broker, use_defaults=False, services=[f"unit{index}.service" for index in range(count)])
+            elapsed = measure(monitor._collect_services, 3)
+            fields = len(monitor._collect_services())
+            close_monitor(monitor)
+            rows.append([count, fields, ms(elapsed), us(elapsed / count)])
+    broker.stop()
+    report.table("Service states via one systemctl show", ["units", "fields", "collect ms", "us per unit"], rows)
+
+
+def bench_backends(report: Report, workdir: Path, quick: bool) -> None:
+    """ProcBackend vs psutil on the same generated /proc with many interfaces."""
+    counts = [4, 200] if quick else [4, 50, 200, 1000]
+    repeat = 200 if quick else 1000
+    rows = []
+    previous_procfs = psutil.PROCFS_PATH
+    try:
+        for count in counts:
+            root = write_proc_root(workdir / f"proc-{count}", count)
+            interfaces = [f"veth{index}" for index in range(count)]
+            psutil.PROCFS_PATH = str(root)
+            for backend in (ProcBackend(str(root)), PsutilBackend()):
+                def read() -> None:
+                    backend.cpu_percent()
+                    backend.memory()
+                    backend.net_counters(interfaces)
+                read()
+                elapsed = measure(read, repeat)
+                rows.append([count, backend.name, us(elapsed), kib(peak_allocation(read))])
+                if isinstance(backend, ProcBackend):
+                    backend.close()
+    finally:
+        psutil.PROCFS_PATH = previous_procfs
+    report.table("CPU + memory + all interfaces per read", ["interfaces", "backend", "us per read", "peak KiB"], rows)
+
+
+def bench_sampler(report: Report, workdir: Path, quick: bool) -> None:
+    """Cost of one high-frequency sample and of aggregating a full window."""
+    root = write_proc_root(workdir / "proc-sampler", 16)
+    rows = []
+    for rate, window in ((1, 30), (10, 30), (10, 300)):
+        backend = ProcBackend(str(root))
+        sampler = HighFrequencySampler(backend, [f"veth{index}" for index in range(16)], rate, window)
+        samples = rate * window
+        sample_time = measure(sampler._sample, min(samples, 500))
+        for _ in range(samples - min(samples, 500)):
+            sampler._sample()
+        collect_time = measure(sampler.collect, 1)
+        buffer_bytes = sum(buffer.values.itemsize * len(buffer.values) for buffer in sampler.buffers.values())
+        rows.append([rate, window, samples, us(sample_time), ms(collect_time), kib(buffer_bytes), f"{sample_time * rate * 100:.3f}"])
+        backend.close()
+    report.table("High-frequency sampler (16 interfaces)", ["Hz", "window s", "samples", "us per sample", "collect ms", "buffers KiB", "% of one core"], rows)
+
+
+def bench_hwmon(report: Report, workdir: Path, quick: bool) -> None:
+    """hwmon index build once vs reading the selected inputs every cycle."""
+    layouts = [(4, 8), (16, 32)] if quick else [(4, 8), (16, 32), (64, 64)]
+    rows = []
+    for chips, inputs in layouts:
+        root = write_hwmon_root(workdir / f"hwmon-{chips}-{inputs}", chips, inputs)
+        build = measure(lambda: HwmonIndex(["*"], str(root)), 3)
+        index = HwmonIndex(["*"], str(root))
+        read = measure(index.read_selected, 50)
+        rows.append([chips, chips * inputs, ms(build), ms(read), us(read / len(index.selected))])
+    report.table("hwmon index and per-cycle reads (all inputs selected)", ["chips", "inputs", "index ms", "read ms", "us per input"], rows)
+
+
+def bench_processes(report: Report, workdir: Path, quick: bool) -> None:
+    """Incremental process table: first scan, steady-state update, top-N and watch matching."""
+    counts = [100, 1000] if quick else [100, 1000, 5000]
+    rows = []
+    for count in counts:
+        root = write_proc_root(workdir / f"proc-processes-{count}", 1, processes=count)
+        table = ProcessTable(str(root))
+        first = measure(table.update, 1)
+        steady = measure(table.update, 5)
+        top = measure(lambda: (table.top(5, lambda entry: entry.cpu_percent), table.top(5, lambda entry: entry.rss)), 20)
+        match = measure(lambda: (table.matching("worker 1*"), table.matching("re:--id 4")), 20)
+        rows.append([count, ms(first), ms(steady), ms(top), ms(match)])
+        for entry in table.entries.values():
+            entry.close()
+    report.table("Process table", ["processes", "first update ms", "update ms", "top 5+5 ms", "2 watches ms"], rows)
+
+
+def bench_cgroups(report: Report, workdir: Path, quick: bool) -> None:
+    counts = [10, 100] if quick else [10, 100, 500]
+    rows = []
+    for count in counts:
+        root = write_cgroup_root(workdir / f"cgroup-{count}", count)
+        collector = CgroupCollector(["system.slice/docker-*.scope"], str(root), rescan_interval=3600)
+        scan = measure(collector.refresh, 1)
+        refresh = measure(collector.refresh, 10)
+        read = measure(collector.read, 10)
+        rows.append([count, ms(scan), us(refresh), ms(read)])
+        for cgroup in collector.cgroups.values():
+            cgroup.close()
+    report.table("cgroup v2 collector", ["cgroups", "first scan ms", "unchanged refresh us", "read ms"], rows)
+
+
+def bench_hub(report: Report, workdir: Path, quick: bool) -> None:
+    """Hub mode: per-run cost of reading one round-robin slice of /proc-root devices."""
+    counts = [50, 200] if quick else [50, 200, 500]
+    rows = []
+    for count in counts:
+        directory = workdir / f"hub-{count}"
+        for index in range(count):
+            root = write_proc_root(directory / f"guest{index}" / "proc", interfaces=4, block_devices=0, processes=1)
+            # Hub devices read the network through PID 1, as a container's procfs needs, and CPU and memory from its cgroup
+            (root / "1" / "net").mkdir()
+            (root / "1" / "net" / "dev").write_bytes((root / "net" / "dev").read_bytes())
+            (root / "1" / "cgroup").write_text(f"0::/system.slice/docker-{index:04x}.scope\n")
+        cgroup_root = write_cgroup_root(workdir / f"hub-{count}-cgroup", count)
+        broker = InProcessBroker()
+        with fake_psutil(FakePsutil()):
+            monitor = make_monitor(directory, broker, use_defaults=False, hub_devices=[str(directory / "*" / "proc")])
+            monitor.hub.cgroup_root = str(cgroup_root)
+            monitor.publish_discovery()
+            first_run = measure(lambda: monitor._collect_hub(), 1)
+            runs = [measure(lambda: monitor._publish_hub_states(monitor._collect_hub()), 1) for _ in range(HUB_SLICES * 3)]
+            close_monitor(monitor)
+            monitor.hub.close()
+        broker.stop()
+        rows.append([count, ms(first_run), ms(statistics.median(runs)), ms(max(runs)), ms(sum(runs) / 3)])
+    report.table(f"Hub mode, {HUB_SLICES} slices per device interval", ["devices", "first run ms", "run p50 ms", "run max ms", "per device interval ms"], rows)
+
+
+def bench_serializer(report: Report, workdir: Path, quick: bool) -> None:
+    """dump_json (orjson when installed) vs stdlib json.dumps on flat state payloads."""
+    rows = []
+    for fields in (100, 1000, 5000):
+        payload: Dict[str, Any] = {}
+        for index in range(fields):
+            payload[f"net_upload_veth{index}"] = round(index * 1.37, 2) if index % 3 else index
+            if index % 10 == 0:
+                payload[f"service_unit{index}_service"] = "active"
+        repeat = 100 if quick else 500
+        fast = measure(lambda: dump_json(payload), repeat)
+        stdlib = measure(lambda: json.dumps(payload), repeat)
+        rows.append([len(payload), "orjson" if system2mqtt.orjson else "json", us(fast), us(stdlib), kib(len(dump_json(payload)))])
+    report.table("State serialization", ["fields", "dump_json backend", "dump_json us", "json.dumps us", "payload KiB"], rows)
+
+
+def bench_slow_sources(report: Report, workdir: Path, quick: bool) -> None:
+    """A slow and a hung data source must cost at most the collector timeout and only mark their own sensors stale."""
+    rows = []
+    for label, fake in (("slow disk_usage (2s)", FakePsutil(interfaces=["veth0"], delay=2.0)), ("hung disk_usage", FakePsutil(interfaces=["veth0"], hang=True))):
+        directory = workdir / f"slow-{len(rows)}"
+        directory.mkdir()
+        broker = InProcessBroker()
+        with fake_psutil(fake):
+            monitor = make_monitor(directory, broker, mountpoints=["/mnt/slow"], interfaces=["veth0"], collector_timeout=0.5)
+            cycles = []
+            for _ in range(3):
+                start = time.perf_counter()
+                monitor.publish_states(force=True)
+                cycles.append(time.perf_counter() - start)
+            unavailable = sorted(monitor.stale_collectors)
+            close_monitor(monitor)
+        broker.stop()
+        rows.append([label, " / ".join(ms(cycle) for cycle in cycles), ",".join(unavailable) or "-", monitor.metrics.deadline_misses])
+    report.table("Slow and hung sources (collector timeout 0.5s, 3 forced cycles)", ["source", "cycle ms", "stale collectors", "deadline misses"], rows)
+
+
+def bench_broker(report: Report, workdir: Path, quick: bool) -> None:
+    """Throughput and publish latency through the broker stand-in at QoS 0 and QoS 1."""
+    cycles = 20 if quick else 200
+    rows = []
+    for qos, ack_delay in ((0, 0.0), (1, 0.002), (1, 0.02)):
+        directory = workdir / f"broker-{qos}-{ack_delay}"
+        directory.mkdir()
+        broker = InProcessBroker(ack_delay=ack_delay)
+        interfaces = [f"veth{index}" for index in range(50)]
+        with fake_psutil(FakePsutil(interfaces=interfaces)):
+            monitor = make_monitor(directory, broker, interfaces=interfaces, publish_mode="changes", full_refresh_cycles=1, qos=qos)
+            monitor.publish_discovery()
+            messages, sent = broker.messages, broker.bytes
+            start = time.perf_counter()
+            for _ in range(cycles):
+                monitor.publish_states(force=True)
+            elapsed = time.perf_counter() - start
+            outstanding = monitor.metrics.outstanding()
+            broker.drain()
+            superseded = monitor.publisher.superseded
+            close_monitor(monitor)
+        broker.stop()
+        count = broker.messages - messages
+        latencies = sorted(broker.latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+        rows.append([qos, ms(ack_delay), count, f"{count / elapsed:.0f}", f"{(broker.bytes - sent) / elapsed / 1024:.0f}", ms(statistics.median(latencies)), ms(p95), outstanding, superseded])
+    report.table(f"Broker stand-in, {cycles} change-only cycles with 50 interfaces", ["qos", "ack delay ms", "messages", "msg/s", "KiB/s", "latency p50 ms", "latency p95 ms", "outstanding at end", "superseded"], rows)
+
+
+BENCHMARKS: Dict[str, Callable[[Report, Path, bool], None]] = {
+    "scaling": bench_scaling,
+    "modes": bench_publish_modes,
+    "services": bench_services,
+    "backends": bench_backends,
+    "sampler": bench_sampler,
+    "hwmon": bench_hwmon,
+    "processes": bench_processes,
+    "cgroups": bench_cgroups,
+    "hub": bench_hub,
+    "serializer": bench_serializer,
+    "slow": bench_slow_sources,
+    "broker": bench_broker,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for system2mqtt.py")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK", help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes and fewer repeats")
+    parser.add_argument("--output", type=Path, help="Also write the report to this file")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s) {', '.join(unknown)}, choose from: {', '.join(BENCHMARKS)}")
+
+    # Missing sources are expected with synthetic names; keep the report readable
+    logging.basicConfig(level=logging.ERROR)
+    output = open(args.output, "w") if args.output else None
+    report = Report(output)
+    report.write(f"system2mqtt benchmarks, Python {sys.version.split()[0]}, psutil {psutil.__version__}, serializer {'orjson' if system2mqtt.orjson else 'json'}")
+    report.write()
+    try:
+        with tempfile.TemporaryDirectory(prefix="system2mqtt-bench-") as tmp:
+            for name in args.benchmarks or BENCHMARKS:
+                workdir = Path(tmp) / name
+                workdir.mkdir()
+                BENCHMARKS[name](report, workdir, args.quick)
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
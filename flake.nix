@@ -29,6 +29,8 @@
               python
               pythonPackages.psutil
               pythonPackages.paho-mqtt
+              pythonPackages.orjson
+              pythonPackages.jeepney
               pythonPackages.dbus-python
             ];
             shellHook = ''
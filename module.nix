@@ -15,11 +15,25 @@ let
   pythonEnv = pkgs.python3.withPackages (ps: [
     ps.psutil
     ps.paho-mqtt
+    ps.orjson
+    ps.jeepney
   ]);
   scriptPath = "${cfg.package}/share/system2mqtt/system2mqtt.py";
   diskArgs = lib.optionalString (cfg.mountpoints != []) "--mountpoints ${lib.escapeShellArgs cfg.mountpoints}";
+  excludeDiskArgs = lib.optionalString (cfg.excludeMountpoints != []) "--exclude-mountpoints ${lib.escapeShellArgs cfg.excludeMountpoints}";
   netArgs = lib.optionalString (cfg.interfaces != []) "--interfaces ${lib.escapeShellArgs cfg.interfaces}";
+  excludeNetArgs = lib.optionalString (cfg.excludeInterfaces != []) "--exclude-interfaces ${lib.escapeShellArgs cfg.excludeInterfaces}";
+  blockDeviceArgs = lib.optionalString (cfg.blockDevices != []) "--block-devices ${lib.escapeShellArgs cfg.blockDevices}";
+  hwmonArgs = lib.optionalString (cfg.hwmonSensors != []) "--hwmon-sensors ${lib.escapeShellArgs cfg.hwmonSensors}";
+  cgroupArgs = lib.optionalString (cfg.cgroups != []) "--cgroups ${lib.escapeShellArgs cfg.cgroups}";
+  hubDeviceArgs = lib.optionalString (cfg.hubDevices != []) "--hub-devices ${lib.escapeShellArgs cfg.hubDevices}";
   serviceArgs = lib.optionalString (cfg.services != []) "--services ${lib.escapeShellArgs cfg.services}";
+  collectorIntervalArgs = lib.optionalString (cfg.collectorIntervals != {})
+    "--collector-intervals ${lib.escapeShellArgs (lib.mapAttrsToList (name: seconds: "${name}=${toString seconds}") cfg.collectorIntervals)}";
+  deadbandArgs = lib.optionalString (cfg.deadbands != {})
+    "--deadbands ${lib.escapeShellArgs (lib.mapAttrsToList (family: threshold: "${family}=${threshold}") cfg.deadbands)}";
+  watchProcessArgs = lib.optionalString (cfg.watchProcesses != {})
+    "--watch-processes ${lib.escapeShellArgs (lib.mapAttrsToList (name: pattern: "${name}=${pattern}") cfg.watchProcesses)}";
 in {
   options.services.system2mqtt = with lib; {
     enable = mkEnableOption "System2MQTT MQTT publisher";
@@ -74,6 +88,51 @@ in {
       description = "Update interval in seconds";
     };
 
+    collectorIntervals = mkOption {
+      type = types.attrsOf types.ints.positive;
+      default = {};
+      example = { system = 5; disks = 600; services = 15; };
+      description = "Per-collector update intervals in seconds (system, temperature, disks, diskio, network, services, processes, samples, cgroups, hub, diagnostics), overriding interval; hwmon sensors are read by temperature, samples also sets the sampler's aggregation window and hub is the time to read every hub device once";
+    };
+
+    collectorTimeout = mkOption {
+      type = types.ints.positive;
+      default = 10;
+      description = "Seconds a collector may run before its sensors are marked unavailable";
+    };
+
+    publishMode = mkOption {
+      type = types.enum [ "full" "changes" ];
+      default = "full";
+      description = "Publish the full state every cycle, or only collectors whose values changed beyond their deadband";
+    };
+
+    deadbands = mkOption {
+      type = types.attrsOf types.str;
+      default = {};
+      example = { cpu_usage = "2"; net_upload = "10%"; };
+      description = "Per sensor family deadbands for change-only publishing, absolute or relative with a % suffix";
+    };
+
+    fullRefreshCycles = mkOption {
+      type = types.ints.positive;
+      default = 10;
+      description = "Republish every collector state after this many cycles in change-only mode";
+    };
+
+    backend = mkOption {
+      type = types.enum [ "auto" "proc" "psutil" ];
+      default = "auto";
+      description = "Metric source for CPU, memory, uptime and network: direct /proc readers or psutil";
+    };
+
+    sampleRate = mkOption {
+      type = types.number;
+      default = 0;
+      example = 1;
+      description = "Sample CPU, memory and network at this rate in Hz and publish min/max/mean/p95 per window (0 disables)";
+    };
+
     defaults = mkOption {
       type = types.bool;
       default = true;
@@ -83,13 +142,155 @@ in {
     mountpoints = mkOption {
       type = types.listOf types.str;
       default = [];
-      description = "Disk mountpoints to monitor";
+      description = "Disk mountpoints to monitor, as paths, shell patterns or re:REGEX";
+    };
+
+    excludeMountpoints = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      description = "Mountpoints to skip, as shell patterns or re:REGEX";
     };
 
     interfaces = mkOption {
       type = types.listOf types.str;
       default = [];
-      description = "Network interfaces to monitor";
+      description = "Network interfaces to monitor, as names, shell patterns or re:REGEX";
+    };
+
+    excludeInterfaces = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      description = "Network interfaces to skip, as shell patterns or re:REGEX";
+    };
+
+    blockDevices = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      description = "Block devices to monitor for throughput and IOPS";
+    };
+
+    serviceEvents = mkOption {
+      type = types.bool;
+      default = false;
+      description = "Publish service state changes from systemd D-Bus signals as they happen, polling only as a consistency check";
+    };
+
+    dbusBus = mkOption {
+      type = types.enum [ "system" "session" ];
+      default = "system";
+      description = "Bus to listen on for service events";
+    };
+
+    serviceEventWindow = mkOption {
+      type = types.number;
+      default = 0.5;
+      description = "Seconds over which bursts of service state changes are coalesced";
+    };
+
+    qos = mkOption {
+      type = types.enum [ 0 1 ];
+      default = 0;
+      description = "QoS for state messages; with 1 the publish latency diagnostic covers the broker's PUBACK";
+    };
+
+    maxInflight = mkOption {
+      type = types.ints.positive;
+      default = 10;
+      description = "Maximum state messages handed to the broker connection but not yet acknowledged";
+    };
+
+    reconnectMinDelay = mkOption {
+      type = types.number;
+      default = 1;
+      description = "Base delay in seconds for the jittered exponential reconnect backoff";
+    };
+
+    reconnectMaxDelay = mkOption {
+      type = types.number;
+      default = 120;
+      description = "Maximum delay in seconds between reconnect attempts";
+    };
+
+    refreshMinInterval = mkOption {
+      type = types.number;
+      default = 5;
+      description = "Minimum seconds between on-demand refreshes requested on system2mqtt/<device>/command or with the Refresh button";
+    };
+
+    historySize = mkOption {
+      type = types.ints.unsigned;
+      default = 1024 * 1024;
+      description = "Bytes for the ring file of counter baselines and metric history kept next to the state file; 0 disables it";
+    };
+
+    diagnostics = mkOption {
+      type = types.bool;
+      default = false;
+      description = "Publish diagnostic sensors for the monitor's own cycle time, collector times, publish latency and memory";
+    };
+
+    metricsPort = mkOption {
+      type = types.port;
+      default = 0;
+      description = "Serve the monitor's own metrics in Prometheus format on this port at /metrics (0 disables)";
+    };
+
+    metricsAddress = mkOption {
+      type = types.str;
+      default = "127.0.0.1";
+      description = "Address for the Prometheus metrics endpoint";
+    };
+
+    discoveryJitter = mkOption {
+      type = types.number;
+      default = 2;
+      description = "Seconds over which discovery re-announcements after a Home Assistant restart are spread (0 disables)";
+    };
+
+    rateSmoothing = mkOption {
+      type = types.number;
+      default = 0;
+      description = "EWMA weight of the previous rate for network and block device rates, 0 to 1 (0 disables)";
+    };
+
+    hwmonSensors = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      example = [ "coretemp:Package*" "nct6775:fan*" ];
+      description = "hwmon temperature/fan inputs to publish, as CHIP[:LABEL] shell patterns";
+    };
+
+    cgroups = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      example = [ "system.slice/docker-*.scope" "machine.slice/*" ];
+      description = "cgroup v2 paths to publish as separate devices, as globs relative to /sys/fs/cgroup";
+    };
+
+    hubDevices = mkOption {
+      type = types.listOf types.str;
+      default = [];
+      example = [ "/var/lib/machines/*/proc" "/run/system2mqtt-agents/*.json" "web1=/srv/web1/proc" ];
+      description = "Other hosts to publish as their own devices over this connection, from /proc roots or JSON snapshot files, as [NAME=]PATH or globs; a /proc root's CPU and memory are read from its init's cgroup v2";
+    };
+
+    cgroupRescanInterval = mkOption {
+      type = types.ints.positive;
+      default = 60;
+      description = "Maximum seconds between full rescans of the cgroup tree";
+    };
+
+    topProcesses = mkOption {
+      type = types.ints.unsigned;
+      default = 0;
+      description = "Publish the top N processes by CPU and by memory (0 disables)";
+    };
+
+    watchProcesses = mkOption {
+      type = types.attrsOf types.str;
+      default = {};
+      example = { web = "nginx*"; backup = "re:backup\\.py"; };
+      description = "Process watch rules: a shell pattern on the process name, or re:REGEX on the command line";
     };
 
     services = mkOption {
@@ -98,6 +299,44 @@ in {
       description = "Systemd services to monitor";
     };
 
+    spool = mkOption {
+      type = types.submodule ({ ... }: {
+        options = {
+          size = mkOption {
+            type = types.ints.positive;
+            default = 1000;
+            description = "Maximum number of state messages kept in memory while the broker is unreachable";
+          };
+
+          policy = mkOption {
+            type = types.enum [ "drop-oldest" "drop-newest" "downsample" ];
+            default = "drop-oldest";
+            description = "What to drop when the spool is full; downsample needs toDisk = false";
+          };
+
+          toDisk = mkOption {
+            type = types.bool;
+            default = false;
+            description = "Spool to append-only segment files next to the state file instead of memory";
+          };
+
+          diskBytes = mkOption {
+            type = types.ints.positive;
+            default = 10485760;
+            description = "Maximum size of the on-disk spool in bytes";
+          };
+
+          replayRate = mkOption {
+            type = types.number;
+            default = 10;
+            description = "Spooled messages replayed per second after reconnecting";
+          };
+        };
+      });
+      default = {};
+      description = "Offline spool settings";
+    };
+
     stateFile = mkOption {
       type = types.str;
       default = "/var/lib/system2mqtt/state.json";
@@ -163,11 +402,46 @@ in {
           --user ${lib.escapeShellArg cfg.mqtt.user} \
           --pass ${passwordArg} \
           --interval ${toString cfg.interval} \
+          --collector-timeout ${toString cfg.collectorTimeout} \
+          --publish-mode ${cfg.publishMode} \
+          --backend ${cfg.backend} \
+          --sample-rate ${toString cfg.sampleRate} \
+          --rate-smoothing ${toString cfg.rateSmoothing} \
+          --discovery-jitter ${toString cfg.discoveryJitter} \
+          --qos ${toString cfg.qos} \
+          --max-inflight ${toString cfg.maxInflight} \
+          --reconnect-min-delay ${toString cfg.reconnectMinDelay} \
+          --reconnect-max-delay ${toString cfg.reconnectMaxDelay} \
+          --refresh-min-interval ${toString cfg.refreshMinInterval} \
+          --history-size ${toString cfg.historySize} \
+          ${lib.optionalString cfg.serviceEvents "--service-events"} \
+          --dbus-bus ${cfg.dbusBus} \
+          --service-event-window ${toString cfg.serviceEventWindow} \
+          --metrics-port ${toString cfg.metricsPort} \
+          --metrics-address ${lib.escapeShellArg cfg.metricsAddress} \
+          ${lib.optionalString cfg.diagnostics "--diagnostics"} \
+          --full-refresh-cycles ${toString cfg.fullRefreshCycles} \
           --state-file ${lib.escapeShellArg cfg.stateFile} \
+          --spool-size ${toString cfg.spool.size} \
+          --spool-policy ${cfg.spool.policy} \
+          --spool-disk-bytes ${toString cfg.spool.diskBytes} \
+          --spool-replay-rate ${toString cfg.spool.replayRate} \
+          ${lib.optionalString cfg.spool.toDisk "--spool-to-disk"} \
           ${lib.optionalString cfg.defaults "--use-defaults"} \
           ${diskArgs} \
+          ${excludeDiskArgs} \
           ${netArgs} \
-          ${serviceArgs}
+          ${excludeNetArgs} \
+          ${blockDeviceArgs} \
+          ${hwmonArgs} \
+          ${cgroupArgs} \
+          ${hubDeviceArgs} \
+          --top-processes ${toString cfg.topProcesses} \
+          ${watchProcessArgs} \
+          --cgroup-rescan-interval ${toString cfg.cgroupRescanInterval} \
+          ${serviceArgs} \
+          ${collectorIntervalArgs} \
+          ${deadbandArgs}
       '';
     };
   };
@@ -7,11 +7,1599 @@ import time
 import argparse
 import logging
 import subprocess
+import os
+import re
+import fnmatch
+import glob
+import itertools
+import resource
+import heapq
+import io
+import cProfile
+import pstats
+import functools
+import hashlib
+import random
+import select
+import mmap
+import struct
+import tempfile
+import math
+import threading
+from array import array
+from collections import Counter, OrderedDict, deque
 from pathlib import Path
-from typing import Dict, Any
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Callable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from jeepney import DBusAddress, HeaderFields, MatchRule, MessageType, message_bus, new_method_call
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+# Properties requested from systemd for every monitored unit in one batched query
+SERVICE_PROPERTIES = ("ActiveState", "SubState", "NRestarts", "MainPID", "MemoryCurrent")
+UINT64_MAX = 2**64 - 1
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# Width of the kernel's unsigned long, in which interface and disk counters are kept;
+# a 32-bit userland on a 64-bit kernel still reads 64-bit counters
+KERNEL_COUNTER_BITS = 64 if "64" in platform.machine() or platform.machine() == "s390x" else 32
+
+COLLECTOR_NAMES = ("system", "temperature", "disks", "diskio", "network", "services", "processes", "samples", "cgroups", "hub", "diagnostics")
+# Collectors that publish their own devices instead of fields in the host state payload
+DEVICE_COLLECTORS = ("cgroups", "hub")
+SAMPLE_AGGREGATES = ("min", "max", "mean", "p95")
+# Seconds after which a publish without a callback is assumed lost rather than outstanding
+MAX_ACK_WAIT = 300
+# With D-Bus service events, polling is only a consistency check at this interval
+SERVICE_CONSISTENCY_INTERVAL = 300
+DBUS_RETRY_SECONDS = 10
+# Longest blocking receive, so the listener notices stop requests
+DBUS_POLL_SECONDS = 1.0
+
+# Ring file layout for persisted counter baselines and metric history: a header with the
+# write position and boot, then fixed 64-byte records
+HISTORY_MAGIC = b"S2MH"
+HISTORY_VERSION = 1
+HISTORY_KEY_BYTES = 35
+HISTORY_HEADER = struct.Struct("<4sHHIIII36s4x")
+HISTORY_RECORD = struct.Struct(f"<dddIB{HISTORY_KEY_BYTES}s")
+# Counter baselines older than this are not reused after a restart
+HISTORY_BASELINE_MAX_AGE = 900
+# Upper bound on buckets per series in a history response
+HISTORY_MAX_POINTS = 120
+
+# rtnetlink protocol and multicast group for link add/remove/change notifications
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 1
+
+# State fields of hub devices, also the fields taken from JSON snapshots
+HUB_FIELDS = ("cpu_usage", "memory_usage", "memory_used", "memory_total", "uptime_seconds", "net_upload", "net_download")
+# Hub devices are read in this many round-robin slices per device interval
+HUB_SLICES = 10
+# A snapshot not rewritten for this many device intervals marks its device offline
+HUB_STALE_INTERVALS = 3
+
+CGROUP_STAT_FILES = ("cpu.stat", "memory.current", "io.stat", "pids.current")
+
+HWMON_INPUT_PATTERN = re.compile(r"(temp|fan)(\d+)_input")
+# hwmon chips that report the CPU package temperature, in order of preference
+CPU_TEMPERATURE_CHIPS = ("coretemp", "k10temp", "zenpower", "cpu_thermal", "cpu-thermal", "soc_thermal", "acpitz")
+
+# State payload keys per monitored target; "{}" is the target's sanitized name
+DISK_FIELDS = ("disk_usage_{}", "disk_used_{}", "disk_total_{}")
+NETWORK_FIELDS = ("net_upload_{}", "net_download_{}", "net_sent_{}", "net_recv_{}")
+BLOCK_DEVICE_FIELDS = ("disk_read_{}", "disk_write_{}", "disk_read_iops_{}", "disk_write_iops_{}")
+SERVICE_FIELDS = ("service_{}", "service_{}_substate", "service_{}_restarts", "service_{}_memory")
+TOP_PROCESS_FIELDS = ("proc_top_cpu_{}", "proc_top_cpu_{}_name", "proc_top_memory_{}", "proc_top_memory_{}_name")
+WATCH_PROCESS_FIELDS = ("proc_{}_count", "proc_{}_cpu", "proc_{}_memory")
+# Entries kept by the name and deadband caches; interface and process names churn on busy
+# container hosts, so the caches are bounded instead of growing for the life of the process
+KEY_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def device_key(name: str) -> str:
+    """Sanitized key fragment for a network interface or block device."""
+    return name.replace('/', '_').replace('-', '_')
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def mount_key(mountpoint: str) -> str:
+    return mountpoint.replace('/', '_').strip('_') or "root"
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def service_key(service: str) -> str:
+    return service.replace('.', '_').replace('-', '_').replace('@', '_')
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def name_key(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def state_keys(safe_name: str, templates: tuple[str, ...]) -> tuple[str, ...]:
+    """State payload keys for one target, formatted once instead of on every collection."""
+    return tuple(template.format(safe_name) for template in templates)
+
+def dump_json(obj: Any) -> bytes:
+    """Serialize a payload to compact JSON bytes, with orjson when installed and the same output from json otherwise."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson.JSONEncodeError, e.g. integers beyond 64 bits; json handles those
+            pass
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+class CollectorSchedule:
+    """Drift-free schedule for a single collector, anchored to the monotonic clock."""
+
+    def __init__(self, name: str, collect: Callable[[], Dict[str, Any]], interval: float) -> None:
+        self.name = name
+        self.collect = collect
+        self.interval = interval
+        self.next_due = time.monotonic()
+        self.last_run: float | None = None
+        self.missed_ticks = 0
+        self.pending: Future | None = None
+
+    def is_due(self, now: float) -> bool:
+        return now >= self.next_due
+
+    def advance(self, now: float) -> None:
+        # Step from the previous deadline rather than from now, and coalesce any
+        # ticks that already passed into a single run instead of catching up
+        self.next_due += self.interval
+        if self.next_due <= now:
+            skipped = int((now - self.next_due) // self.interval) + 1
+            self.missed_ticks += skipped
+            self.next_due += skipped * self.interval
+
+class CounterRate:
+    """Per-second rates of cumulative counters with wrap/reset detection and optional EWMA smoothing."""
+
+    def __init__(self, smoothing: float = 0.0, counter_bits: int = KERNEL_COUNTER_BITS) -> None:
+        # Weight given to the previous smoothed rate; 0 disables smoothing
+        self.smoothing = smoothing
+        # Counters wrap at this width; a drop that doesn't fit a wrap is a reset
+        self.wrap = 2**counter_bits
+        self.samples: Dict[str, tuple[int, float]] = {}
+        self.rates: Dict[str, float] = {}
+
+    def update(self, key: str, value: int, timestamp: float) -> float | None:
+        """Record a counter reading taken at a monotonic timestamp and return its rate, if known."""
+        prev = self.samples.get(key)
+        self.samples[key] = (value, timestamp)
+        if prev is None:
+            return None
+        prev_value, prev_time = prev
+        elapsed = timestamp - prev_time
+        if elapsed <= 0:
+            return self.rates.get(key)
+
+        delta = value - prev_value
+        if delta < 0:
+            # A counter that wrapped lands just past zero; anything else is a reset
+            # (driver reload, interface re-created) and the new reading becomes the baseline.
+            # 64-bit counters never wrap in practice, so there every decrease is a reset.
+            wrapped = delta + self.wrap
+            if prev_value < self.wrap and 0 <= wrapped < self.wrap // 2:
+                delta = wrapped
+            else:
+                self.rates.pop(key, None)
+                return None
+
+        rate = delta / elapsed
+        if self.smoothing and key in self.rates:
+            rate = self.smoothing * self.rates[key] + (1 - self.smoothing) * rate
+        self.rates[key] = rate
+        return rate
+
+    def forget(self, key: str) -> None:
+        self.samples.pop(key, None)
+        self.rates.pop(key, None)
+
+class PsutilBackend:
+    """Portable metric source built on psutil."""
+
+    name = "psutil"
+
+    def __init__(self) -> None:
+        self.prev_cpu_times: tuple[float, float] | None = None
+
+    def cpu_percent(self) -> float:
+        # Non-blocking: measures CPU usage since this backend's previous call. Kept per
+        # instance rather than using psutil.cpu_percent's module-wide state so that
+        # the sampler and the system collector don't reset each other's window.
+        times = psutil.cpu_times()
+        total = sum(times) - getattr(times, "guest", 0) - getattr(times, "guest_nice", 0)
+        busy = total - times.idle - getattr(times, "iowait", 0)
+        prev = self.prev_cpu_times
+        self.prev_cpu_times = (busy, total)
+        if prev is None or total <= prev[1]:
+            return 0.0
+        return round(max(0.0, min(100.0, (busy - prev[0]) / (total - prev[1]) * 100)), 1)
+
+    def memory(self) -> tuple[float, int, int]:
+        memory = psutil.virtual_memory()
+        return memory.percent, memory.used, memory.total
+
+    def uptime(self) -> float:
+        return time.time() - psutil.boot_time()
+
+    def net_counters(self, interfaces: list) -> Dict[str, tuple[int, int]]:
+        net_io = psutil.net_io_counters(pernic=True)
+        return {
+            iface: (net_io[iface].bytes_sent, net_io[iface].bytes_recv)
+            for iface in interfaces
+            if iface in net_io
+        }
+
+    def disk_counters(self, devices: list) -> Dict[str, tuple[int, int, int, int]]:
+        disk_io = psutil.disk_io_counters(perdisk=True) or {}
+        return {
+            device: (disk_io[device].read_bytes, disk_io[device].write_bytes, disk_io[device].read_count, disk_io[device].write_count)
+            for device in devices
+            if device in disk_io
+        }
+
+class ProcFile:
+    """A procfs/sysfs file held open and re-read in place with pread into a reused buffer."""
+
+    def __init__(self, path: str, size: int = 4096) -> None:
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buffer = bytearray(size)
+
+    def read(self) -> bytearray:
+        while True:
+            length = os.preadv(self.fd, [self.buffer], 0)
+            if length < len(self.buffer):
+                return self.buffer[:length]
+            # File outgrew the buffer, grow it and read again from the start
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class ProcBackend:
+    """Linux fast path reading /proc/stat, /proc/meminfo, /proc/net/dev and /proc/uptime directly."""
+
+    name = "proc"
+
+    def __init__(self, proc_root: str = "/proc", net_dev: str = "net/dev", disks: bool = True) -> None:
+        opened: list[ProcFile] = []
+        try:
+            self.stat = self._open(opened, f"{proc_root}/stat")
+            self.meminfo = self._open(opened, f"{proc_root}/meminfo")
+            self.net_dev = self._open(opened, f"{proc_root}/{net_dev}", 16384)
+            self.uptime_file = self._open(opened, f"{proc_root}/uptime", 128)
+            self.diskstats = self._open(opened, f"{proc_root}/diskstats", 16384) if disks else None
+        except OSError:
+            # Callers retry on the next interval, so release what was opened before the failure
+            for proc_file in opened:
+                proc_file.close()
+            raise
+        self.prev_cpu_times: tuple[int, int] | None = None
+        # Configured names by their encoded line key, rebuilt only when the configured list changes
+        self.name_indexes: Dict[str, tuple[tuple[str, ...], Dict[bytes, str]]] = {}
+
+    @staticmethod
+    def _open(opened: list[ProcFile], path: str, size: int = 4096) -> ProcFile:
+        proc_file = ProcFile(path, size=size)
+        opened.append(proc_file)
+        return proc_file
+
+    def cpu_percent(self) -> float:
+        data = self.stat.read()
+        # First line: "cpu  user nice system idle iowait irq softirq steal guest guest_nice";
+        # guest time is already included in user/nice, so only the first eight fields count
+        fields = data[:data.find(b"\n")].split()[1:9]
+        times = [int(value) for value in fields]
+        total = sum(times)
+        busy = total - times[3] - times[4]
+        prev = self.prev_cpu_times
+        self.prev_cpu_times = (busy, total)
+        if prev is None or total <= prev[1]:
+            return 0.0
+        return round(max(0.0, min(100.0, (busy - prev[0]) / (total - prev[1]) * 100)), 1)
+
+    def memory(self) -> tuple[float, int, int]:
+        data = self.meminfo.read()
+        total = self._meminfo_value(data, b"MemTotal:")
+        available = self._meminfo_value(data, b"MemAvailable:")
+        if available is None:
+            # Kernels before 3.14 have no MemAvailable
+            available = sum(self._meminfo_value(data, key) or 0 for key in (b"MemFree:", b"Buffers:", b"Cached:"))
+        used = total - available
+        return round(used / total * 100, 1), used, total
+
+    def _meminfo_value(self, data: bytearray, key: bytes) -> int | None:
+        start = data.find(key)
+        if start < 0:
+            return None
+        end = data.find(b"\n", start)
+        return int(data[start + len(key):end].split()[0]) * 1024
+
+    def uptime(self) -> float:
+        data = self.uptime_file.read()
+        return float(data.split()[0])
+
+    def net_counters(self, interfaces: list) -> Dict[str, tuple[int, int]]:
+        wanted = self._name_index("net", interfaces)
+        counters: Dict[str, tuple[int, int]] = {}
+        # Lines look like "  eth0: <rx bytes> ... <tx bytes> ..." after two header lines
+        for line in bytes(self.net_dev.read()).split(b"\n")[2:]:
+            name, _, rest = line.partition(b":")
+            iface = wanted.get(name.strip())
+            if iface is not None:
+                fields = rest.split()
+                # Receive bytes is the first column, transmit bytes the ninth
+                counters[iface] = (int(fields[8]), int(fields[0]))
+        return counters
+
+    def disk_counters(self, devices: list) -> Dict[str, tuple[int, int, int, int]]:
+        wanted = self._name_index("disk", devices)
+        counters: Dict[str, tuple[int, int, int, int]] = {}
+        # Lines look like "   8       0 sda <reads> <merged> <sectors read> <ms> <writes> <merged> <sectors written> ..."
+        for line in bytes(self.diskstats.read()).split(b"\n"):
+            fields = line.split()
+            device = wanted.get(fields[2]) if len(fields) > 9 else None
+            if device is not None:
+                counters[device] = (int(fields[5]) * 512, int(fields[9]) * 512, int(fields[3]), int(fields[7]))
+        return counters
+
+    def _name_index(self, kind: str, names: list) -> Dict[bytes, str]:
+        """Map the encoded line key of each configured name back to the name, so a read parses every line once."""
+        key = tuple(names)
+        cached = self.name_indexes.get(kind)
+        if cached is None or cached[0] != key:
+            cached = self.name_indexes[kind] = (key, {name.encode(): name for name in names})
+        return cached[1]
+
+    def close(self) -> None:
+        for proc_file in (self.stat, self.meminfo, self.net_dev, self.uptime_file, self.diskstats):
+            if proc_file is not None:
+                proc_file.close()
+
+def atomic_write_text(path: Path, text: str) -> None:
+    """Replace path with text through a synced temporary file, so a crash never leaves it truncated."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # A unique temporary file per call, so concurrent writers can't interleave into the same one
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        # mkstemp creates the file 0600; keep the replaced file's mode
+        try:
+            os.fchmod(fd, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.fchmod(fd, 0o644)
+        with open(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def raise_open_file_limit() -> None:
+    """Raise the soft open-file limit to the hard limit; held-open stat files quickly exceed the default 1024."""
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+def is_target_pattern(entry: str) -> bool:
+    return entry.startswith("re:") or glob.has_magic(entry)
+
+def matches_target(name: str, patterns: list) -> bool:
+    # "re:<regex>" entries are full-match regular expressions, anything else a shell pattern
+    for pattern in patterns:
+        if pattern.startswith("re:"):
+            if re.fullmatch(pattern[3:], name):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+class MountTableWatcher:
+    """Reports mount table changes by polling /proc/self/mountinfo, which signals POLLPRI on every mount or unmount."""
+
+    def __init__(self, path: str = "/proc/self/mountinfo") -> None:
+        self.file = open(path, "rb")
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+
+    def changed(self) -> bool:
+        return bool(self.poller.poll(0))
+
+    def mountpoints(self) -> list[str]:
+        self.file.seek(0)
+        mountpoints: list[str] = []
+        for line in self.file.read().splitlines():
+            fields = line.split(b" ", 5)
+            if len(fields) > 4:
+                # Spaces and other special characters are octal-escaped, e.g. "\040"
+                mountpoints.append(re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), fields[4].decode(errors="replace")))
+        return mountpoints
+
+class InterfaceWatcher:
+    """Reports network interface changes from rtnetlink link notifications, or by re-listing /sys/class/net without netlink."""
+
+    def __init__(self, path: str = "/sys/class/net") -> None:
+        self.path = path
+        self.known = set(self.interfaces())
+        try:
+            self.socket: socket.socket | None = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.socket.bind((0, RTMGRP_LINK))
+            self.socket.setblocking(False)
+        except (OSError, AttributeError):
+            self.socket = None
+
+    def changed(self) -> bool:
+        if self.socket is None:
+            current = set(self.interfaces())
+            changed = current != self.known
+            self.known = current
+            return changed
+
+        changed = False
+        while True:
+            try:
+                self.socket.recv(65536)
+                changed = True
+            except BlockingIOError:
+                return changed
+            except OSError:
+                # Receive buffer overflowed; notifications were lost, so assume a change
+                return True
+
+    def interfaces(self) -> list[str]:
+        try:
+            return sorted(os.listdir(self.path))
+        except OSError:
+            return []
+
+class HwmonSensor:
+    """A single hwmon temperature or fan input."""
+
+    __slots__ = ("chip", "label", "kind", "key", "path", "input")
+
+    def __init__(self, chip: str, label: str, kind: str, key: str, path: str) -> None:
+        self.chip = chip
+        self.label = label
+        self.kind = kind
+        self.key = key
+        self.path = path
+        self.input: ProcFile | None = None
+
+    def read(self) -> float | None:
+        try:
+            if self.input is None:
+                self.input = ProcFile(self.path, size=32)
+            value = int(self.input.read())
+        except (OSError, ValueError):
+            return None
+        # Temperatures are reported in millidegrees Celsius, fans in RPM
+        return round(value / 1000, 1) if self.kind == "temp" else value
+
+class HwmonIndex:
+    """One-time index of /sys/class/hwmon; each cycle reads only the selected inputs through held-open descriptors."""
+
+    def __init__(self, selectors: list | None = None, root: str = "/sys/class/hwmon") -> None:
+        self.sensors = self._scan(root)
+        # Selectors are "chip:label" shell patterns; a bare chip pattern selects all its inputs
+        patterns = [(selector.partition(":")[0], selector.partition(":")[2] or "*") for selector in selectors or []]
+        self.selected = [
+            sensor for sensor in self.sensors
+            if any(fnmatch.fnmatch(sensor.chip, chip) and fnmatch.fnmatch(sensor.label, label) for chip, label in patterns)
+        ]
+        self.cpu_sensor = self._find_cpu_sensor()
+
+    def _scan(self, root: str) -> list[HwmonSensor]:
+        sensors: list[HwmonSensor] = []
+        seen_keys: set[str] = set()
+        try:
+            hwmon_dirs = sorted(os.listdir(root), key=lambda name: int(name[5:]) if name[5:].isdigit() else 0)
+        except OSError:
+            return sensors
+        for hwmon in hwmon_dirs:
+            directory = f"{root}/{hwmon}"
+            chip = self._read_attribute(f"{directory}/name") or hwmon
+            try:
+                inputs = sorted(
+                    (match.group(1), int(match.group(2)))
+                    for match in map(HWMON_INPUT_PATTERN.fullmatch, os.listdir(directory))
+                    if match
+                )
+            except OSError:
+                continue
+            for kind, number in inputs:
+                label = self._read_attribute(f"{directory}/{kind}{number}_label") or f"{kind}{number}"
+                key = re.sub(r"[^a-z0-9]+", "_", f"{chip}_{label}".lower()).strip("_")
+                # Multi-socket boards expose several chips with the same name
+                base_key, suffix = key, 2
+                while key in seen_keys:
+                    key = f"{base_key}_{suffix}"
+                    suffix += 1
+                seen_keys.add(key)
+                sensors.append(HwmonSensor(chip, label, kind, key, f"{directory}/{kind}{number}_input"))
+        return sensors
+
+    def _read_attribute(self, path: str) -> str | None:
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                return handle.read().strip()
+        except OSError:
+            return None
+
+    def _find_cpu_sensor(self) -> HwmonSensor | None:
+        temperatures = [sensor for sensor in self.sensors if sensor.kind == "temp"]
+        for chip in CPU_TEMPERATURE_CHIPS:
+            for sensor in temperatures:
+                if sensor.chip == chip:
+                    return sensor
+        return temperatures[0] if temperatures else None
+
+    def cpu_temperature(self) -> float | None:
+        return self.cpu_sensor.read() if self.cpu_sensor else None
+
+    def read_selected(self) -> Dict[str, float]:
+        readings: Dict[str, float] = {}
+        for sensor in self.selected:
+            value = sensor.read()
+            if value is not None:
+                readings[sensor.key] = value
+        return readings
+
+class CgroupStats:
+    """Held-open stat files of one cgroup v2 directory."""
+
+    __slots__ = ("path", "key", "name", "files")
+
+    def __init__(self, path: str, key: str, name: str) -> None:
+        self.path = path
+        self.key = key
+        self.name = name
+        self.files: Dict[str, ProcFile] = {}
+        for filename in CGROUP_STAT_FILES:
+            try:
+                self.files[filename] = ProcFile(f"{path}/{filename}")
+            except OSError:
+                # Controller not enabled for this cgroup
+                continue
+
+    def read(self) -> tuple[int | None, int | None, int, int, int | None]:
+        """Return (cpu usage usec, memory bytes, io read bytes, io write bytes, pids); raises OSError once the cgroup is gone."""
+        cpu_usage = memory = pids = None
+        io_read = io_write = 0
+        if "cpu.stat" in self.files:
+            data = self.files["cpu.stat"].read()
+            start = data.find(b"usage_usec ")
+            if start >= 0:
+                cpu_usage = int(data[start + 11:data.find(b"\n", start)])
+        if "memory.current" in self.files:
+            memory = int(self.files["memory.current"].read())
+        if "io.stat" in self.files:
+            # One line per device: "8:0 rbytes=... wbytes=... rios=... wios=... dbytes=... dios=..."
+            for field in self.files["io.stat"].read().split():
+                if field.startswith(b"rbytes="):
+                    io_read += int(field[7:])
+                elif field.startswith(b"wbytes="):
+                    io_write += int(field[7:])
+        if "pids.current" in self.files:
+            pids = int(self.files["pids.current"].read())
+        return cpu_usage, memory, io_read, io_write, pids
+
+    def close(self) -> None:
+        for stat_file in self.files.values():
+            stat_file.close()
+
+class CgroupCollector:
+    """Incremental walker of the cgroup v2 tree.
+
+    Matching cgroups are found with glob patterns relative to the cgroup root.
+    The tree is only re-globbed when a watched parent directory changes, a
+    tracked cgroup disappears, or the rescan interval passes (not every cgroup
+    filesystem updates directory mtimes), so steady-state cycles just re-read
+    held-open stat files.
+    """
+
+    def __init__(self, patterns: list, root: str = "/sys/fs/cgroup", rescan_interval: float = 60) -> None:
+        self.patterns = patterns
+        self.root = root
+        self.rescan_interval = rescan_interval
+        # The static prefix of each pattern is the directory whose children can change the match set
+        self.watch_dirs = {
+            os.path.join(root, *[part for part in itertools.takewhile(lambda part: not glob.has_magic(part), pattern.split("/")[:-1])])
+            for pattern in patterns
+        }
+        self.dir_mtimes: Dict[str, float] = {}
+        self.next_rescan = 0.0
+        self.needs_rescan = True
+        self.cgroups: Dict[str, CgroupStats] = {}
+        # Four held-open files per cgroup
+        raise_open_file_limit()
+
+    def _tree_changed(self) -> bool:
+        changed = False
+        for directory in self.watch_dirs:
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                mtime = 0.0
+            if self.dir_mtimes.get(directory) != mtime:
+                self.dir_mtimes[directory] = mtime
+                changed = True
+        return changed
+
+    def refresh(self) -> tuple[list[CgroupStats], list[CgroupStats]]:
+        """Re-glob the tree if it may have changed; return the (added, removed) cgroups."""
+        now = time.monotonic()
+        if not (self._tree_changed() or self.needs_rescan or now >= self.next_rescan):
+            return [], []
+        self.needs_rescan = False
+        self.next_rescan = now + self.rescan_interval
+
+        found: Dict[str, str] = {}
+        for pattern in self.patterns:
+            for path in glob.glob(os.path.join(self.root, pattern)):
+                if os.path.isdir(path):
+                    relative = os.path.relpath(path, self.root)
+                    found[re.sub(r"[^A-Za-z0-9]+", "_", relative).strip("_").lower()] = path
+
+        removed = [self.cgroups.pop(key) for key in list(self.cgroups) if key not in found]
+        for cgroup in removed:
+            cgroup.close()
+        added: list[CgroupStats] = []
+        for key, path in found.items():
+            if key not in self.cgroups:
+                name = os.path.basename(path).removesuffix(".scope").removesuffix(".service")
+                self.cgroups[key] = CgroupStats(path, key, name)
+                added.append(self.cgroups[key])
+        return added, removed
+
+    def read(self) -> Dict[str, tuple[int | None, int | None, int, int, int | None]]:
+        readings: Dict[str, tuple[int | None, int | None, int, int, int | None]] = {}
+        for key, cgroup in self.cgroups.items():
+            try:
+                readings[key] = cgroup.read()
+            except (OSError, ValueError):
+                # Removed between scans; drop it on the next refresh
+                self.needs_rescan = True
+        return readings
+
+class HubDevice:
+    """A host published by the hub, read from a bind-mounted /proc root or a JSON snapshot pushed by an agent.
+
+    A container's procfs shows the hub host's stat, meminfo and uptime, so for
+    a proc root whose init runs in its own cgroup, CPU and memory come from that
+    cgroup (CPU as a share of the whole host, like cgroup devices) and uptime
+    from the init's start time. They're left out under cgroup v1, where the
+    init's cgroup can't be found.
+    """
+
+    def __init__(self, name: str, path: str, cgroup_root: str = "/sys/fs/cgroup") -> None:
+        self.name = name
+        # Same id a system2mqtt running on that host would use, so its entities carry over
+        self.device_id = name.replace('.', '_').replace('-', '_')
+        self.path = path
+        self.cgroup_root = cgroup_root
+        self.snapshot = not os.path.isdir(path)
+        self.backend: ProcBackend | None = None
+        # cgroup v2 path of the root's init: "/" when it's the hub host itself, None when unknown
+        self.init_cgroup: str | None = None
+        self.cgroup: CgroupStats | None = None
+        self.memory_max: ProcFile | None = None
+        self.init_start = 0.0
+        self.cpu_count = psutil.cpu_count() or 1
+        self.snapshot_mtime: float | None = None
+        self.snapshot_state: Dict[str, Any] = {}
+        self.available: bool | None = None
+
+    def read(self, rates: CounterRate, stale_after: float) -> Dict[str, Any]:
+        """Current state of the device; raises OSError or ValueError when it can't be read or has gone stale."""
+        return self._read_snapshot(stale_after) if self.snapshot else self._read_proc(rates)
+
+    def _open_proc(self) -> None:
+        # In a container's procfs, net is a symlink to self/net, and self doesn't resolve from
+        # outside its PID namespace; its init's view of the network is the container's.
+        # Disk counters aren't published for hub devices.
+        backend = ProcBackend(self.path, net_dev="1/net/dev", disks=False)
+        try:
+            with open(f"{self.path}/1/stat", "rb") as handle:
+                # Start time in clock ticks since boot is the 20th field after the command name
+                self.init_start = int(handle.read().rpartition(b")")[2].split()[19]) / os.sysconf("SC_CLK_TCK")
+            with open(f"{self.path}/1/cgroup", "rb") as handle:
+                # Shown relative to our own cgroup namespace, so it's the full path from the hub
+                self.init_cgroup = next((line[3:].decode() for line in handle.read().splitlines() if line.startswith(b"0::")), None)
+            if self.init_cgroup not in (None, "/"):
+                cgroup_path = os.path.join(self.cgroup_root, self.init_cgroup.lstrip("/"))
+                self.cgroup = CgroupStats(cgroup_path, self.device_id, self.name)
+                try:
+                    self.memory_max = ProcFile(f"{cgroup_path}/memory.max", size=64)
+                except OSError:
+                    # Memory controller not enabled; the host's total is the limit
+                    self.memory_max = None
+        except (OSError, ValueError, IndexError):
+            backend.close()
+            self.close()
+            raise
+        self.backend = backend
+
+    def _read_proc(self, rates: CounterRate) -> Dict[str, Any]:
+        if self.backend is None:
+            self._open_proc()
+        now = time.monotonic()
+        state: Dict[str, Any] = {}
+        memory: tuple[float, int, int] | None = None
+        if self.init_cgroup == "/":
+            state["cpu_usage"] = self.backend.cpu_percent()
+            memory = self.backend.memory()
+        elif self.cgroup is not None:
+            cpu_usage, memory_used, _, _, _ = self.cgroup.read()
+            if cpu_usage is not None:
+                cpu_rate = rates.update(f"hub:{self.device_id}:cpu", cpu_usage, now) or 0.0
+                state["cpu_usage"] = round(cpu_rate / 1e6 * 100 / self.cpu_count, 1)
+            if memory_used is not None:
+                limit = self.memory_max.read().strip() if self.memory_max is not None else b"max"
+                memory_total = self.backend.memory()[2] if limit == b"max" else int(limit)
+                memory = (memory_used / memory_total * 100, memory_used, memory_total)
+        if memory is not None:
+            memory_percent, memory_used, memory_total = memory
+            state["memory_usage"] = round(memory_percent, 1)
+            state["memory_used"] = round(memory_used / (1024**3), 2)
+            state["memory_total"] = round(memory_total / (1024**3), 2)
+        state["uptime_seconds"] = int(self.backend.uptime() - self.init_start)
+        # Total over all interfaces but loopback; /proc/net/dev starts with two header lines
+        sent = received = 0
+        for line in bytes(self.backend.net_dev.read()).splitlines()[2:]:
+            iface, _, counters = line.partition(b":")
+            if iface.strip() != b"lo":
+                fields = counters.split()
+                received += int(fields[0])
+                sent += int(fields[8])
+        state["net_upload"] = round((rates.update(f"hub:{self.device_id}:sent", sent, now) or 0.0) * 8 / (1024**2), 2)
+        state["net_download"] = round((rates.update(f"hub:{self.device_id}:recv", received, now) or 0.0) * 8 / (1024**2), 2)
+        return state
+
+    def _read_snapshot(self, stale_after: float) -> Dict[str, Any]:
+        mtime = os.stat(self.path).st_mtime
+        if time.time() - mtime > stale_after:
+            raise ValueError(f"snapshot not updated for {time.time() - mtime:.0f}s")
+        if mtime != self.snapshot_mtime:
+            with open(self.path, "rb") as handle:
+                snapshot = json.load(handle)
+            if not isinstance(snapshot, dict):
+                raise ValueError("snapshot is not a JSON object")
+            self.snapshot_state = {
+                field: snapshot[field]
+                for field in HUB_FIELDS
+                if isinstance(snapshot.get(field), (int, float)) and not isinstance(snapshot[field], bool)
+            }
+            self.snapshot_mtime = mtime
+        return self.snapshot_state
+
+    def close(self) -> None:
+        for held in (self.backend, self.cgroup, self.memory_max):
+            if held is not None:
+                held.close()
+        self.backend = self.cgroup = self.memory_max = None
+
+class HubCollector:
+    """Devices published by hub mode, read round-robin in slices.
+
+    Sources are NAME=PATH entries or glob patterns; a path is either a /proc
+    root (a directory) or a JSON snapshot file. Devices from patterns are named
+    after the snapshot file, or after the directory holding a proc root. Each
+    run reads one of HUB_SLICES slices, so a device is read once every
+    HUB_SLICES runs and the work per run stays flat as devices are added.
+    """
+
+    def __init__(self, sources: list, slices: int = HUB_SLICES, cgroup_root: str = "/sys/fs/cgroup") -> None:
+        self.sources = sources
+        self.cgroup_root = cgroup_root
+        self.slices = slices
+        self.run = 0
+        self.devices: Dict[str, HubDevice] = {}
+        # Up to nine held-open files per proc root
+        raise_open_file_limit()
+
+    def refresh(self) -> tuple[list[HubDevice], list[HubDevice]]:
+        """Re-glob the sources; return the (added, removed) devices."""
+        found: Dict[str, str] = {}
+        for source in self.sources:
+            name, separator, path = source.partition("=")
+            if separator:
+                found[name] = path
+                continue
+            for path in sorted(glob.glob(source)):
+                source_path = Path(path)
+                found[source_path.parent.name if source_path.name == "proc" else source_path.name.removesuffix(".json")] = path
+
+        removed = [self.devices.pop(name) for name in list(self.devices) if self.devices[name].path != found.get(name)]
+        for device in removed:
+            device.close()
+        added: list[HubDevice] = []
+        for name, path in sorted(found.items()):
+            if name not in self.devices:
+                self.devices[name] = HubDevice(name, path, self.cgroup_root)
+                added.append(self.devices[name])
+        return added, removed
+
+    def next_slice(self) -> list[HubDevice]:
+        index = self.run % self.slices
+        self.run += 1
+        return list(self.devices.values())[index::self.slices]
+
+    def close(self) -> None:
+        for device in self.devices.values():
+            device.close()
+
+class ProcessEntry:
+    """Cached static attributes and held-open stat files of one process."""
+
+    __slots__ = ("pid", "start_time", "name", "cmdline", "stat", "statm", "cpu_ticks", "cpu_percent", "rss")
+
+    def __init__(self, pid: int, proc_root: str) -> None:
+        self.pid = pid
+        self.stat = ProcFile(f"{proc_root}/{pid}/stat", size=1024)
+        try:
+            self.statm = ProcFile(f"{proc_root}/{pid}/statm", size=256)
+        except OSError:
+            # Exited between the two opens
+            self.stat.close()
+            raise
+        try:
+            with open(f"{proc_root}/{pid}/cmdline", "rb") as handle:
+                self.cmdline = handle.read().replace(b"\0", b" ").decode(errors="replace").strip()
+        except OSError:
+            self.cmdline = ""
+        self.start_time: int | None = None
+        self.name = ""
+        self.cpu_ticks: int | None = None
+        self.cpu_percent = 0.0
+        self.rss = 0
+
+    def close(self) -> None:
+        self.stat.close()
+        self.statm.close()
+
+class ProcessTable:
+    """Incremental process table: static attributes are cached per PID and only stat/statm are re-read each cycle."""
+
+    def __init__(self, proc_root: str = "/proc") -> None:
+        self.proc_root = proc_root
+        self.entries: Dict[int, ProcessEntry] = {}
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.prev_time: float | None = None
+        raise_open_file_limit()
+
+    def update(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.prev_time if self.prev_time is not None else None
+        self.prev_time = now
+
+        pids = {int(name) for name in os.listdir(self.proc_root) if name.isdigit()}
+        for pid in [pid for pid in self.entries if pid not in pids]:
+            self.entries.pop(pid).close()
+
+        for pid in pids:
+            entry = self.entries.get(pid)
+            if entry is None:
+                try:
+                    entry = self.entries[pid] = ProcessEntry(pid, self.proc_root)
+                except OSError:
+                    # Exited between listdir and open
+                    continue
+            try:
+                stat = entry.stat.read()
+                statm = entry.statm.read()
+            except OSError:
+                self.entries.pop(pid).close()
+                continue
+            # The name is enclosed in parentheses and may itself contain spaces or parentheses
+            name_end = stat.rfind(b")")
+            fields = stat[name_end + 2:].split()
+            start_time = int(fields[19])
+            if entry.start_time != start_time:
+                if entry.start_time is not None:
+                    # PID reused by a new process: start over with fresh static attributes
+                    entry.close()
+                    try:
+                        entry = self.entries[pid] = ProcessEntry(pid, self.proc_root)
+                    except OSError:
+                        self.entries.pop(pid)
+                        continue
+                entry.start_time = start_time
+                entry.name = stat[stat.find(b"(") + 1:name_end].decode(errors="replace")
+            cpu_ticks = int(fields[11]) + int(fields[12])
+            if entry.cpu_ticks is not None and elapsed:
+                entry.cpu_percent = (cpu_ticks - entry.cpu_ticks) / self.clock_ticks / elapsed * 100
+            entry.cpu_ticks = cpu_ticks
+            entry.rss = int(statm.split()[1]) * PAGE_SIZE
+
+    def top(self, count: int, key: Callable[[ProcessEntry], float]) -> list[ProcessEntry]:
+        return heapq.nlargest(count, self.entries.values(), key=key)
+
+    def matching(self, pattern: str) -> list[ProcessEntry]:
+        # "re:<regex>" searches the command line, anything else is a shell pattern on the process name
+        if pattern.startswith("re:"):
+            regex = re.compile(pattern[3:])
+            return [entry for entry in self.entries.values() if regex.search(entry.cmdline)]
+        return [entry for entry in self.entries.values() if fnmatch.fnmatchcase(entry.name, pattern)]
+
+class RingBuffer:
+    """Fixed-capacity ring of float samples backed by a compact array."""
+
+    __slots__ = ("values", "start", "count")
+
+    def __init__(self, capacity: int) -> None:
+        self.values = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+    def append(self, value: float) -> None:
+        capacity = len(self.values)
+        if self.count < capacity:
+            self.values[(self.start + self.count) % capacity] = value
+            self.count += 1
+        else:
+            # Full: overwrite the oldest sample
+            self.values[self.start] = value
+            self.start = (self.start + 1) % capacity
+
+    def drain(self) -> tuple[float, float, float, float] | None:
+        """Return (min, max, mean, p95) of the buffered samples and start a new window."""
+        if not self.count:
+            return None
+        capacity = len(self.values)
+        end = self.start + self.count
+        if end <= capacity:
+            window = sorted(self.values[self.start:end])
+        else:
+            window = sorted(self.values[self.start:] + self.values[:end - capacity])
+        self.start = 0
+        self.count = 0
+        p95 = window[max(0, math.ceil(len(window) * 0.95) - 1)]
+        return window[0], window[-1], sum(window) / len(window), p95
+
+class HighFrequencySampler:
+    """Samples CPU, memory and per-interface throughput at a high rate between publishes."""
+
+    def __init__(self, backend: "PsutilBackend | ProcBackend", interfaces: list, rate: float, window_seconds: float) -> None:
+        self.backend = backend
+        self.interfaces = interfaces
+        self.period = 1 / rate
+        # Room for one full publish window plus slack for a late collection
+        self.capacity = math.ceil(rate * window_seconds * 1.5) + 1
+        self.buffers: Dict[str, RingBuffer] = {"cpu_usage": RingBuffer(self.capacity), "memory_usage": RingBuffer(self.capacity)}
+        for iface in interfaces:
+            iface_safe = device_key(iface)
+            self.buffers[f"net_upload_{iface_safe}"] = RingBuffer(self.capacity)
+            self.buffers[f"net_download_{iface_safe}"] = RingBuffer(self.capacity)
+        self.rates = CounterRate()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+
+    def set_interfaces(self, interfaces: list) -> None:
+        """Sample a new interface list, keeping the buffers of interfaces that are still there."""
+        with self.lock:
+            for iface in self.interfaces:
+                if iface not in interfaces:
+                    upload_key, download_key, _, _ = state_keys(device_key(iface), NETWORK_FIELDS)
+                    self.buffers.pop(upload_key, None)
+                    self.buffers.pop(download_key, None)
+                    self.rates.forget(f"{iface}:sent")
+                    self.rates.forget(f"{iface}:recv")
+            for iface in interfaces:
+                upload_key, download_key, _, _ = state_keys(device_key(iface), NETWORK_FIELDS)
+                self.buffers.setdefault(upload_key, RingBuffer(self.capacity))
+                self.buffers.setdefault(download_key, RingBuffer(self.capacity))
+            self.interfaces = interfaces
+
+    def start(self) -> None:
+        self.backend.cpu_percent()
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def _run(self) -> None:
+        next_sample = time.monotonic() + self.period
+        while not self.stop_event.wait(max(0.0, next_sample - time.monotonic())):
+            self._sample()
+            # Same drift-free stepping as the collectors; late samples are skipped, not bunched
+            next_sample += self.period
+            now = time.monotonic()
+            if next_sample <= now:
+                next_sample += math.ceil((now - next_sample) / self.period) * self.period
+
+    def _sample(self) -> None:
+        cpu_usage = self.backend.cpu_percent()
+        memory_percent, _, _ = self.backend.memory()
+        net_io = self.backend.net_counters(self.interfaces) if self.interfaces else {}
+        now = time.monotonic()
+        with self.lock:
+            self.buffers["cpu_usage"].append(cpu_usage)
+            self.buffers["memory_usage"].append(memory_percent)
+            for iface, (bytes_sent, bytes_recv) in net_io.items():
+                upload_key, download_key, _, _ = state_keys(device_key(iface), NETWORK_FIELDS)
+                if upload_key not in self.buffers:
+                    # Removed by set_interfaces while this sample was being read
+                    continue
+                upload_rate = self.rates.update(f"{iface}:sent", bytes_sent, now)
+                download_rate = self.rates.update(f"{iface}:recv", bytes_recv, now)
+                if upload_rate is not None:
+                    self.buffers[upload_key].append(upload_rate * 8 / (1024**2))
+                if download_rate is not None:
+                    self.buffers[download_key].append(download_rate * 8 / (1024**2))
+
+    def collect(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        with self.lock:
+            for field, buffer in self.buffers.items():
+                aggregates = buffer.drain()
+                if aggregates is None:
+                    continue
+                for suffix, value in zip(SAMPLE_AGGREGATES, aggregates):
+                    state[f"{field}_{suffix}"] = round(value, 2)
+        return state
+
+def unit_name_from_path(path: str) -> str:
+    """Reverse systemd's bus path escaping, e.g. /org/freedesktop/systemd1/unit/nginx_2eservice -> nginx.service."""
+    return re.sub(r"_([0-9a-f]{2})", lambda match: chr(int(match.group(1), 16)), path.rsplit("/", 1)[-1])
+
+class ServiceEventWatcher:
+    """Listens for systemd PropertiesChanged signals on the watched units and reports coalesced state changes.
+
+    Changes are collected until the window has passed since the first one, so a
+    restart loop produces one update per window with the latest state. The
+    watcher reconnects on bus errors and tells its owner through on_status so
+    the owner can fall back to polling in the meantime.
+    """
+
+    def __init__(self, services: list, bus: str, window: float, on_changes: Callable[[Dict[str, Dict[str, str]]], None], on_status: Callable[[bool], None], logger: logging.Logger) -> None:
+        self.services = set(services)
+        self.bus = bus
+        self.window = window
+        self.on_changes = on_changes
+        self.on_status = on_status
+        self.logger = logger
+        self.pending: Dict[str, Dict[str, str]] = {}
+        self.flush_at: float | None = None
+        self.connection = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="service-events", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.connection is not None:
+            self.connection.close()
+
+    def _run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                if self.stop_event.is_set():
+                    return
+                self.logger.warning(f"Lost D-Bus connection for service events, polling until reconnected: {e}")
+            if self.stop_event.is_set():
+                return
+            self.on_status(False)
+            self.stop_event.wait(DBUS_RETRY_SECONDS)
+
+    def _listen(self) -> None:
+        self.connection = open_dbus_connection(bus=self.bus.upper())
+        try:
+            manager = DBusAddress("/org/freedesktop/systemd1", bus_name="org.freedesktop.systemd1", interface="org.freedesktop.systemd1.Manager")
+            # Without Subscribe, systemd only emits unit signals while another client is subscribed
+            try:
+                reply = self.connection.send_and_get_reply(new_method_call(manager, "Subscribe"), timeout=5)
+                if reply.header.message_type == MessageType.error:
+                    self.logger.debug(f"systemd Subscribe failed, relying on other subscribers: {reply.body}")
+            except TimeoutError:
+                self.logger.debug("systemd Subscribe timed out, relying on other subscribers")
+
+            # The bus resolves the well-known sender name; signals themselves carry systemd's unique name,
+            # so the local filter below must not check the sender
+            self.connection.send_and_get_reply(message_bus.AddMatch(self._unit_properties_rule("org.freedesktop.systemd1")), timeout=5)
+            rule = self._unit_properties_rule()
+            self.logger.info(f"Listening for state changes of {len(self.services)} unit(s) on the {self.bus} bus")
+            self.on_status(True)
+
+            with self.connection.filter(rule, bufsize=1024) as queue:
+                while not self.stop_event.is_set():
+                    timeout = DBUS_POLL_SECONDS if self.flush_at is None else max(0.0, self.flush_at - time.monotonic())
+                    try:
+                        message = self.connection.recv_until_filtered(queue, timeout=timeout)
+                    except TimeoutError:
+                        message = None
+                    if message is not None:
+                        self._handle(message)
+                    if self.flush_at is not None and time.monotonic() >= self.flush_at:
+                        changes, self.pending, self.flush_at = self.pending, {}, None
+                        self.on_changes(changes)
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def _unit_properties_rule(self, sender: str | None = None) -> "MatchRule":
+        rule = MatchRule(
+            type="signal",
+            sender=sender,
+            interface="org.freedesktop.DBus.Properties",
+            member="PropertiesChanged",
+            path_namespace="/org/freedesktop/systemd1/unit",
+        )
+        rule.add_arg_condition(0, "org.freedesktop.systemd1.Unit")
+        return rule
+
+    def _handle(self, message: Any) -> None:
+        service = unit_name_from_path(message.header.fields.get(HeaderFields.path, ""))
+        if service not in self.services:
+            return
+        _, changed, _ = message.body
+        status: Dict[str, str] = {}
+        if "ActiveState" in changed:
+            status["active_state"] = changed["ActiveState"][1]
+        if "SubState" in changed:
+            status["sub_state"] = changed["SubState"][1]
+        if not status:
+            return
+        self.pending.setdefault(service, {}).update(status)
+        if self.flush_at is None:
+            self.flush_at = time.monotonic() + self.window
+
+class StateSpool:
+    """Bounded store for state messages produced while the broker is unreachable.
+
+    Samples are kept in an in-memory ring, or appended to on-disk segment files
+    when a segment path is given so they also survive a restart. Both are capped
+    at max_samples, and disk use also by max_segment_bytes, regardless of how
+    long the outage lasts. On disk, drop-oldest drops the older of two segments
+    at a time and downsampling is not supported.
+    """
+
+    def __init__(self, max_samples: int, policy: str = "drop-oldest", segment_path: Path | None = None, max_segment_bytes: int = 10 * 1024**2) -> None:
+        if segment_path is not None and policy == "downsample":
+            raise ValueError("the downsample spool policy only works with the in-memory spool")
+        self.max_samples = max_samples
+        self.policy = policy
+        self.segment_path = segment_path
+        # Two segments of half the budget each: the older one is dropped on rotation
+        self.max_segment_bytes = max_segment_bytes // 2
+        self.max_segment_samples = max(1, (max_samples + 1) // 2)
+        self.samples: deque[tuple[float, str, bytes]] = deque()
+        # Downsampling keeps every stride-th sample of a topic, doubling the stride of the
+        # topic holding the most samples each time the ring fills, so every topic keeps a share
+        self.strides: Dict[str, int] = {}
+        self.skipped: Dict[str, int] = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # Records per segment file, counted once here and kept up to date so len() never re-reads the files
+        self.segment_counts: Dict[Path, int] = {}
+        if segment_path is not None:
+            for path in self._segment_paths():
+                self.segment_counts[path] = sum(1 for _ in self._iter_records(path))
+
+    def append(self, topic: str, payload: bytes, timestamp: float) -> None:
+        with self.lock:
+            if self.segment_path is not None:
+                self._append_to_segment(topic, payload, timestamp)
+                return
+
+            if self.policy == "downsample":
+                skipped = self.skipped.get(topic, 0) + 1
+                if skipped < self.strides.get(topic, 1):
+                    self.skipped[topic] = skipped
+                    self.dropped += 1
+                    return
+                self.skipped[topic] = 0
+
+            if len(self.samples) >= self.max_samples:
+                if self.policy == "drop-newest":
+                    self.dropped += 1
+                    return
+                if self.policy == "downsample":
+                    self._thin_busiest_topic()
+                else:
+                    self.samples.popleft()
+                    self.dropped += 1
+            self.samples.append((timestamp, topic, payload))
+
+    def _thin_busiest_topic(self) -> None:
+        """Drop every other sample of the topic holding the most samples and double its stride."""
+        counts = Counter(topic for _, topic, _ in self.samples)
+        busiest = max(counts, key=counts.__getitem__)
+        kept: deque[tuple[float, str, bytes]] = deque()
+        seen = 0
+        for sample in self.samples:
+            if sample[1] == busiest:
+                seen += 1
+                if seen % 2 == 0:
+                    self.dropped += 1
+                    continue
+            kept.append(sample)
+        self.samples = kept
+        self.strides[busiest] = self.strides.get(busiest, 1) * 2
+
+    def _append_to_segment(self, topic: str, payload: bytes, timestamp: float) -> None:
+        line = json.dumps({"timestamp": timestamp, "topic": topic, "payload": payload.decode()}) + "\n"
+        previous = self._previous_segment_path()
+        if self.policy == "drop-newest" and len(self) >= self.max_samples:
+            self.dropped += 1
+            return
+        try:
+            self.segment_path.parent.mkdir(parents=True, exist_ok=True)
+            current_count = self.segment_counts.get(self.segment_path, 0)
+            full = (
+                current_count >= self.max_segment_samples
+                or current_count + self.segment_counts.get(previous, 0) >= self.max_samples
+                or (self.segment_path.exists() and self.segment_path.stat().st_size + len(line) > self.max_segment_bytes)
+            )
+            if full:
+                if self.policy == "drop-newest" and self.segment_counts.get(previous, 0):
+                    self.dropped += 1
+                    return
+                # Rotating drops the previous segment's samples
+                self.dropped += self.segment_counts.get(previous, 0)
+                os.replace(self.segment_path, previous)
+                self.segment_counts[previous] = self.segment_counts.get(self.segment_path, 0)
+                self.segment_counts[self.segment_path] = 0
+            with open(self.segment_path, "a", encoding="utf-8") as handle:
+                handle.write(line)
+            self.segment_counts[self.segment_path] = self.segment_counts.get(self.segment_path, 0) + 1
+        except OSError:
+            self.dropped += 1
+
+    def _previous_segment_path(self) -> Path:
+        return self.segment_path.with_name(f"{self.segment_path.name}.1")
+
+    def _replay_segment_path(self) -> Path:
+        return self.segment_path.with_name(f"{self.segment_path.name}.replay")
+
+    def _segment_paths(self) -> tuple[Path, Path, Path]:
+        """Segment files oldest first: samples being replayed, then the previous and current segments."""
+        return self._replay_segment_path(), self._previous_segment_path(), self.segment_path
+
+    def __len__(self) -> int:
+        if self.segment_path is not None:
+            return sum(self.segment_counts.values())
+        return len(self.samples)
+
+    def _iter_records(self, path: Path) -> Iterator[tuple[float, str, bytes]]:
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                        yield record["timestamp"], record["topic"], record["payload"].encode()
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+        except OSError:
+            return
+
+    def replay(self, publish: Callable[[float, str, bytes], None], rate: float, should_continue: Callable[[], bool]) -> int:
+        """Hand spooled samples to publish, oldest first, at most rate per second."""
+        replayed = 0
+        next_send = time.monotonic()
+        if self.segment_path is not None:
+            replay_path = self._replay_segment_path()
+            with self.lock:
+                # Move the segments aside so samples spooled during the replay go to fresh ones
+                try:
+                    with open(replay_path, "a", encoding="utf-8") as handle:
+                        for path in (self._previous_segment_path(), self.segment_path):
+                            if path.exists():
+                                handle.write(path.read_text(encoding="utf-8"))
+                                path.unlink()
+                            self.segment_counts[replay_path] = self.segment_counts.get(replay_path, 0) + self.segment_counts.pop(path, 0)
+                except OSError:
+                    return replayed
+            # The replay file is removed only after a complete replay, so an interrupted replay repeats samples rather than losing them
+            for timestamp, topic, payload in self._iter_records(replay_path):
+                if not should_continue():
+                    return replayed
+                time.sleep(max(0.0, next_send - time.monotonic()))
+                next_send = max(next_send + 1 / rate, time.monotonic())
+                publish(timestamp, topic, payload)
+                replayed += 1
+            with self.lock:
+                replay_path.unlink(missing_ok=True)
+                self.segment_counts[replay_path] = 0
+            return replayed
+
+        while should_continue():
+            with self.lock:
+                if not self.samples:
+                    self.strides.clear()
+                    self.skipped.clear()
+                    break
+                timestamp, topic, payload = self.samples.popleft()
+            time.sleep(max(0.0, next_send - time.monotonic()))
+            next_send = max(next_send + 1 / rate, time.monotonic())
+            publish(timestamp, topic, payload)
+            replayed += 1
+        return replayed
+
+class MetricHistory:
+    """Fixed-size ring of counter readings and gauge samples in a memory-mapped file.
+
+    Records carry monotonic timestamps and a boot sequence number, so counter
+    baselines can seed rate calculations after a restart within the same boot,
+    plus wall-clock timestamps for history queries. The file never grows past
+    max_bytes; the oldest records are overwritten once the ring is full.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, boot_id: str) -> None:
+        self.path = path
+        self.capacity = (max_bytes - HISTORY_HEADER.size) // HISTORY_RECORD.size
+        if self.capacity < 1:
+            raise ValueError(f"history size must be at least {HISTORY_HEADER.size + HISTORY_RECORD.size} bytes")
+        self.lock = threading.Lock()
+        size = HISTORY_HEADER.size + self.capacity * HISTORY_RECORD.size
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                # A different size means a different ring layout; start over rather than reinterpret it
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, record_size, capacity, self.head, self.count, self.boot_seq, stored_boot_id = HISTORY_HEADER.unpack_from(self.map)
+        if fresh or magic != HISTORY_MAGIC or version != HISTORY_VERSION or record_size != HISTORY_RECORD.size or capacity != self.capacity:
+            self.head = self.count = self.boot_seq = 0
+            stored_boot_id = b""
+        self.boot_id = boot_id.encode()[:36]
+        if stored_boot_id.rstrip(b"\0") != self.boot_id:
+            # Monotonic timestamps restart with the kernel; older records stay queryable by wall time only
+            self.boot_seq += 1
+        self._write_header()
+
+    def _write_header(self) -> None:
+        HISTORY_HEADER.pack_into(self.map, 0, HISTORY_MAGIC, HISTORY_VERSION, HISTORY_RECORD.size, self.capacity, self.head, self.count, self.boot_seq, self.boot_id)
+
+    def record(self, samples: list[tuple[str, float, float, bool]]) -> None:
+        """Append (key, value, monotonic timestamp, is_counter) samples."""
+        offset = time.time() - time.monotonic()
+        with self.lock:
+            for key, value, timestamp, counter in samples:
+                encoded = key.encode()
+                if len(encoded) > HISTORY_KEY_BYTES:
+                    continue
+                HISTORY_RECORD.pack_into(self.map, HISTORY_HEADER.size + self.head * HISTORY_RECORD.size, timestamp, timestamp + offset, value, self.boot_seq, counter, encoded)
+                self.head = (self.head + 1) % self.capacity
+                self.count = min(self.count + 1, self.capacity)
+            self._write_header()
+
+    def _records(self) -> Iterator[tuple[float, float, float, int, int, str]]:
+        """Records oldest first as (monotonic, wall, value, boot_seq, is_counter, key)."""
+        with self.lock:
+            start, count = (self.head - self.count) % self.capacity, self.count
+            data = self.map[HISTORY_HEADER.size:]
+        records = list(HISTORY_RECORD.iter_unpack(data))
+        for index in range(start, start + count):
+            timestamp, wall, value, boot_seq, counter, key = records[index % self.capacity]
+            yield timestamp, wall, value, boot_seq, counter, key.rstrip(b"\0").decode(errors="replace")
+
+    def baselines(self, max_age: float) -> Dict[str, tuple[int, float]]:
+        """Latest reading of each counter recorded in this boot within max_age seconds, as CounterRate samples."""
+        now = time.monotonic()
+        baselines: Dict[str, tuple[int, float]] = {}
+        for timestamp, _, value, boot_seq, counter, key in self._records():
+            if counter and boot_seq == self.boot_seq and 0 <= now - timestamp <= max_age:
+                baselines[key] = (int(value), timestamp)
+        return baselines
+
+    def query(self, since: float, step: float, patterns: list[str]) -> Dict[str, list[list[float]]]:
+        """Roll samples newer than the wall time since up into step-second [start, min, mean, max] buckets.
+
+        Counters are turned into per-second rates between consecutive readings first.
+        """
+        buckets: Dict[str, Dict[int, list[float]]] = {}
+        previous: Dict[str, tuple[float, float, int]] = {}
+        for timestamp, wall, value, boot_seq, counter, key in self._records():
+            if patterns and not any(fnmatch.fnmatchcase(key, pattern) for pattern in patterns):
+                continue
+            if counter:
+                last = previous.get(key)
+                previous[key] = (value, timestamp, boot_seq)
+                if last is None or last[2] != boot_seq or timestamp <= last[1] or value < last[0]:
+                    continue
+                value = (value - last[0]) / (timestamp - last[1])
+            if wall < since:
+                continue
+            buckets.setdefault(key, {}).setdefault(int((wall - since) // step), []).append(value)
+
+        series: Dict[str, list[list[float]]] = {}
+        for key, by_bucket in buckets.items():
+            series[key] = [
+                [round(since + index * step, 3), round(min(values), 3), round(sum(values) / len(values), 3), round(max(values), 3)]
+                for index, values in sorted(by_bucket.items())
+            ]
+        return series
+
+    def close(self) -> None:
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+
+class PublishPipeline:
+    """Latest-value publish queue in front of paho.
+
+    At most one message per topic waits to be sent; a newer state for the same
+    topic replaces the queued one, so after a stall the broker gets the freshest
+    value instead of a backlog. Messages are handed to paho only while fewer
+    than max_inflight are unacknowledged (QoS 1) or unwritten (QoS 0). The
+    queue is bounded by the number of state topics, and no topic's latest
+    value is ever dropped to make room for another's.
+    """
+
+    def __init__(self, max_inflight: int, on_send: Callable[[int], None]) -> None:
+        self.max_inflight = max_inflight
+        self.on_send = on_send
+        self.client: mqtt.Client | None = None
+        self.pending: OrderedDict[str, tuple[bytes, int, bool]] = OrderedDict()
+        self.inflight: set[int] = set()
+        # Ids whose callback ran before publish() returned them
+        self.early_acknowledged: set[int] = set()
+        self.sending = 0
+        self.superseded = 0
+        self.lock = threading.Lock()
+
+    def submit(self, topic: str, payload: bytes, qos: int, retain: bool) -> None:
+        with self.lock:
+            if topic in self.pending:
+                # Replacing keeps the topic's place in line, so busy topics can't starve the others
+                self.superseded += 1
+            self.pending[topic] = (payload, qos, retain)
+        self.drain()
+
+    def drain(self) -> None:
+        while True:
+            with self.lock:
+                if not self.pending or len(self.inflight) + self.sending >= self.max_inflight:
+                    return
+                topic, (payload, qos, retain) = self.pending.popitem(last=False)
+                self.sending += 1
+            # paho's callbacks take its own locks, so publish outside ours
+            message = self.client.publish(topic, payload, qos=qos, retain=retain)
+            with self.lock:
+                self.sending -= 1
+                if message.mid in self.early_acknowledged:
+                    self.early_acknowledged.discard(message.mid)
+                elif message.rc == mqtt.MQTT_ERR_SUCCESS or qos > 0:
+                    # paho keeps QoS 1 messages it couldn't send yet and delivers them after reconnecting
+                    self.inflight.add(message.mid)
+                if not self.sending:
+                    # Anything left was acknowledged for a message sent outside the pipeline
+                    self.early_acknowledged.clear()
+            self.on_send(message.mid)
+
+    def acknowledged(self, mid: int) -> None:
+        with self.lock:
+            if mid in self.inflight:
+                self.inflight.discard(mid)
+            elif self.sending:
+                # Only a message still inside publish() can be acknowledged before its id is known;
+                # other ids belong to discovery, availability and replay messages
+                self.early_acknowledged.add(mid)
+        self.drain()
+
+    def reset_inflight(self) -> None:
+        # QoS 0 messages lost with a connection never get a callback
+        with self.lock:
+            self.inflight.clear()
+            self.early_acknowledged.clear()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+class SelfMetrics:
+    """Timings, publish latency and queue depth of the monitor itself, for diagnostic sensors and /metrics."""
+
+    def __init__(self) -> None:
+        self.collector_wall: Dict[str, float] = {}
+        self.collector_cpu: Dict[str, float] = {}
+        self.cycle_duration = 0.0
+        self.deadline_misses = 0
+        # Send time by message id until paho reports it written (QoS 0) or acknowledged (QoS 1)
+        self.unacknowledged: Dict[int, float] = {}
+        # Ids whose callback ran before publish() returned, which paho does for fast QoS 0 writes
+        self.early_acknowledged: set[int] = set()
+        self.latencies: deque[float] = deque(maxlen=100)
+        self.lock = threading.Lock()
+        self.process = psutil.Process()
+
+    def record_collector(self, name: str, wall: float, cpu: float) -> None:
+        self.collector_wall[name] = wall
+        self.collector_cpu[name] = cpu
+
+    def published(self, mid: int) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if mid in self.early_acknowledged:
+                self.early_acknowledged.discard(mid)
+                self.latencies.append(0.0)
+                return
+            self.unacknowledged[mid] = now
+
+    def acknowledged(self, mid: int) -> None:
+        now = time.monotonic()
+        with self.lock:
+            sent = self.unacknowledged.pop(mid, None)
+            if sent is None:
+                self.early_acknowledged.add(mid)
+            else:
+                self.latencies.append(now - sent)
+
+    def outstanding(self) -> int:
+        cutoff = time.monotonic() - MAX_ACK_WAIT
+        with self.lock:
+            # QoS 0 messages lost with a dropped connection are never reported
+            for mid in [mid for mid, sent in self.unacknowledged.items() if sent < cutoff]:
+                del self.unacknowledged[mid]
+            self.early_acknowledged.clear()
+            return len(self.unacknowledged)
+
+    def publish_latency(self) -> float | None:
+        """Mean latency of the last 100 publishes in seconds."""
+        with self.lock:
+            return sum(self.latencies) / len(self.latencies) if self.latencies else None
+
+    def rss(self) -> int:
+        return self.process.memory_info().rss
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the monitor's own metrics in Prometheus text format on /metrics."""
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+def create_metrics_backend(backend: str, logger: logging.Logger) -> "PsutilBackend | ProcBackend":
+    if backend in ("auto", "proc"):
+        try:
+            return ProcBackend()
+        except OSError as e:
+            if backend == "proc":
+                logger.warning(f"Could not open /proc metric files, falling back to psutil: {e}")
+    return PsutilBackend()
 
 class SystemMonitor:
-    def __init__(self, mqtt_host: str, mqtt_port: int, mqtt_user: str, mqtt_pass: str, use_defaults: bool = True, update_interval: int = 30, mountpoints: list | None = None, interfaces: list | None = None, services: list | None = None, state_file: str | None = None) -> None:
+    def __init__(self, mqtt_host: str, mqtt_port: int, mqtt_user: str, mqtt_pass: str, use_defaults: bool = True, update_interval: int = 30, mountpoints: list | None = None, interfaces: list | None = None, services: list | None = None, state_file: str | None = None, collector_intervals: Dict[str, int] | None = None, collector_timeout: float = 10, publish_mode: str = "full", deadbands: Dict[str, tuple[float, bool]] | None = None, full_refresh_cycles: int = 10, backend: str = "auto", sample_rate: float = 0, block_devices: list | None = None, rate_smoothing: float = 0.0, spool_size: int = 1000, spool_policy: str = "drop-oldest", spool_to_disk: bool = False, spool_disk_bytes: int = 10 * 1024**2, spool_replay_rate: float = 10, hwmon_sensors: list | None = None, cgroups: list | None = None, cgroup_rescan_interval: float = 60, top_processes: int = 0, watch_processes: Dict[str, str] | None = None, exclude_mountpoints: list | None = None, exclude_interfaces: list | None = None, discovery_jitter: float = 2.0, diagnostics: bool = False, metrics_port: int = 0, metrics_address: str = "127.0.0.1", profile_cycles: int = 0, qos: int = 0, service_events: bool = False, dbus_bus: str = "system", service_event_window: float = 0.5, max_inflight: int = 10, reconnect_min_delay: float = 1, reconnect_max_delay: float = 120, refresh_min_interval: float = 5, history_bytes: int = 1024**2, hub_devices: list | None = None) -> None:
         # Initialize logger
         self.logger = logging.getLogger("SystemMonitor")
         
@@ -22,38 +1610,169 @@ class SystemMonitor:
         self.mqtt_pass = mqtt_pass
         self.use_defaults = use_defaults
         self.update_interval = update_interval
-        self.mountpoints = mountpoints
-        self.interfaces = interfaces
         self.services = services
+        self.block_devices = block_devices
         self.state_file = Path(state_file) if state_file else None
+        self.collector_intervals = collector_intervals or {}
+
+        # Push service state changes from systemd's D-Bus signals; polling becomes a consistency check
+        self.service_events: ServiceEventWatcher | None = None
+        if service_events and services:
+            if open_dbus_connection is None:
+                self.logger.warning("Service events need the jeepney package, polling services instead")
+            else:
+                self.service_poll_interval = self.collector_intervals.get("services", update_interval)
+                self.collector_intervals.setdefault("services", max(SERVICE_CONSISTENCY_INTERVAL, update_interval))
+                self.service_events = ServiceEventWatcher(services, dbus_bus, service_event_window, self._on_service_events, self._on_service_events_status, self.logger)
+        self.collector_timeout = collector_timeout
+        self.backend = create_metrics_backend(backend, self.logger)
+
+        # Mountpoints and interfaces may be glob or re: patterns; these are resolved now and
+        # re-resolved only when the mount table or the set of interfaces changes
+        self.mountpoint_patterns = mountpoints or []
+        self.interface_patterns = interfaces or []
+        self.exclude_mountpoints = exclude_mountpoints or []
+        self.exclude_interfaces = exclude_interfaces or []
+        self.mount_watcher = MountTableWatcher() if any(map(is_target_pattern, self.mountpoint_patterns)) else None
+        self.interface_watcher = InterfaceWatcher() if any(map(is_target_pattern, self.interface_patterns)) else None
+        self.mountpoints = self._resolve_mountpoints()
+        self.interfaces = self._resolve_interfaces()
+        self.sample_rate = sample_rate
+
+        # Connection tracking and offline spool
+        self.connected = threading.Event()
+        spool_path = self.state_file.with_name("spool.jsonl") if spool_to_disk and self.state_file else None
+        self.spool = StateSpool(spool_size, spool_policy, spool_path, spool_disk_bytes)
+        self.spool_replay_rate = spool_replay_rate
+        self.replay_thread: threading.Thread | None = None
+        self.publisher = PublishPipeline(max_inflight, lambda mid: self.metrics.published(mid))
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_failures = 0
+        self.stopping = threading.Event()
+        self.network_thread: threading.Thread | None = None
+        self.publish_mode = publish_mode
+        self.deadbands = deadbands or {}
+        self.full_refresh_cycles = full_refresh_cycles
 
         # Device info
         self.hostname = socket.gethostname()
         self.device_id = self.hostname.replace('.', '_').replace('-', '_')
-        self.distro = self._get_distro_name()
-        self.virtualization = self._get_virtualization_type()
         self.sw_version = f"{platform.system()} {platform.release()}"
-        self.hw_version = self._get_hw_version()
 
-        # Check if CPU temperature sensor is available
-        self.cpu_temp_available = self._get_cpu_temperature() is not None
+        # Optional per-cgroup devices, walked incrementally
+        self.cgroups = CgroupCollector(cgroups, rescan_interval=cgroup_rescan_interval) if cgroups else None
+        self.cpu_count = psutil.cpu_count() or 1
+
+        # Hub mode: other hosts published as their own devices over this connection
+        self.hub = HubCollector(hub_devices) if hub_devices else None
+        self.hub_interval = self.collector_intervals.get("hub", update_interval)
+        # Retained topics of removed hub devices still to be cleared once connected
+        self.pending_removals: set[str] = set()
+
+        # Optional process monitoring backed by an incremental process table
+        self.top_processes = top_processes
+        self.watch_processes = watch_processes or {}
+        self.processes = ProcessTable() if top_processes > 0 or self.watch_processes else None
+
+        # Index hwmon inputs once; cycles only read the selected files
+        self.hwmon = HwmonIndex(hwmon_sensors)
+
+        # Slow-to-detect facts (distro, virtualization, temperature sensor) are cached per boot
+        self.boot_id = self._get_boot_id()
+        self.facts_file = self.state_file.with_name("facts.json") if self.state_file else None
+        facts = self._load_device_facts()
+        if facts is None:
+            facts = {
+                "distro": self._get_distro_name(),
+                "virtualization": self._get_virtualization_type(),
+                "cpu_temp_available": self._get_cpu_temperature() is not None
+            }
+            self._save_device_facts(facts)
+        self.distro = facts["distro"]
+        self.virtualization = facts["virtualization"]
+        self.hw_version = self._get_hw_version()
+        self.cpu_temp_available = facts["cpu_temp_available"]
 
         # MQTT topics and discovery config
         self.discovery_prefix = "homeassistant"
         self.base_topic = f"system2mqtt/{self.device_id}"
         self.availability_topic = f"{self.base_topic}/availability"
         self.state_topic = f"{self.base_topic}/state"
+        self.replay_topic = f"{self.base_topic}/replay"
+        self.command_topic = f"{self.base_topic}/command"
+        self.history_request_topic = f"{self.base_topic}/history/request"
+        self.history_response_topic = f"{self.base_topic}/history/response"
+        self.config_topic = f"{self.discovery_prefix}/device/{self.device_id}/config"
+        self.qos = qos
+
+        # Self-instrumentation, published by the "diagnostics" collector and served on /metrics
+        self.metrics = SelfMetrics()
+        self.diagnostics = diagnostics
+        self.metrics_port = metrics_port
+        self.metrics_address = metrics_address
+        self.metrics_server: ThreadingHTTPServer | None = None
+        self.profile_cycles = profile_cycles
+        self.profiling = False
+
+        # Network and block device I/O rates. Baselines recorded earlier in this boot are reused,
+        # otherwise take one now so the first publish already has rates
+        self.rates = CounterRate(rate_smoothing)
+        self.history = self._open_history(history_bytes)
+        self.history_recorded_until = time.monotonic()
+        # History requests are answered one at a time; only the latest waiting request is kept
+        self.history_lock = threading.Lock()
+        self.history_waiting: bytes | None = None
+        self.history_thread: threading.Thread | None = None
+        if self.history:
+            self.rates.samples.update(self.history.baselines(HISTORY_BASELINE_MAX_AGE))
+        if self.interfaces and not any(key.startswith("net:") for key in self.rates.samples):
+            self._collect_network()
+        if self.block_devices and not any(key.startswith("diskio:") for key in self.rates.samples):
+            self._collect_block_devices()
+
+        # Optional high-frequency sampler feeding windowed aggregates to the "samples" collector
+        self.sampler: HighFrequencySampler | None = None
+        if self.use_defaults and sample_rate > 0:
+            window_seconds = self.collector_intervals.get("samples", self.update_interval)
+            self.sampler = HighFrequencySampler(create_metrics_backend(backend, self.logger), self.interfaces or [], sample_rate, window_seconds)
+
+        # Collectors run on their own drift-free schedules; results are cached per collector
+        self.collectors = self._build_collectors()
+        self.collector_states: Dict[str, Dict[str, Any]] = {}
+        self.stale_collectors: set[str] = set()
+        # Held while collector results are merged and published; service events publish from their own thread
+        self.publish_lock = threading.Lock()
+
+        # On-demand refreshes from the command topic; requests are merged until the rate limit allows a run
+        self.refresh_min_interval = refresh_min_interval
+        self.requested_collectors: set[str] = set()
+        self.last_refresh = float("-inf")
+        self.refresh_lock = threading.Lock()
+        self.wakeup = threading.Event()
+
         self.discovery_payload = self._generate_discovery_payload()
+        # Serialized discovery configs and their hashes by config topic, dropped whenever a config changes
+        self.discovery_cache: Dict[str, tuple[bytes, str]] = {}
+        self.discovery_jitter = discovery_jitter
+        # Bumped by every publish_discovery; only the latest one records its hashes
+        self.discovery_generation = 0
 
-        # Network I/O tracking for rate calculations
-        self.prev_net_io: Dict[str, Any] = {}
-        self.prev_net_time: float | None = None
+        # Change-only publishing: last published snapshot per collector and resolved deadbands per field
+        self.last_published_states: Dict[str, Dict[str, Any]] = {}
+        self.deadband_cache: Dict[str, tuple[float, bool] | None] = {}
+        self.cycles_since_full_refresh = 0
+        # One worker per collector bounds the pool; a hung collector holds at most its own worker
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.collectors)), thread_name_prefix="collector")
         
-        # Initialize CPU percent to avoid blocking on first call
+        # Take a non-blocking CPU baseline; the first reading covers the time until the first publish
         if self.use_defaults:
-            psutil.cpu_percent(interval=1)
+            self.backend.cpu_percent()
 
     def _get_cpu_temperature(self) -> float | None:
+        if self.hwmon.cpu_sensor is not None:
+            return self.hwmon.cpu_temperature()
+        # No hwmon temperature inputs (e.g. thermal zones only), let psutil look further
         try:
             temps = psutil.sensors_temperatures()
             if not temps:
@@ -120,12 +1839,43 @@ class SystemMonitor:
             return f"{platform.machine()} (virtual: {self.virtualization})"
         return platform.machine()
 
+    def _get_boot_id(self) -> str | None:
+        try:
+            with open("/proc/sys/kernel/random/boot_id", "r", encoding="utf-8") as handle:
+                return handle.read().strip()
+        except OSError:
+            return None
+
+    def _load_device_facts(self) -> Dict[str, Any] | None:
+        if self.facts_file is None or self.boot_id is None or not self.facts_file.exists():
+            return None
+        try:
+            data = json.loads(self.facts_file.read_text())
+        except (json.JSONDecodeError, OSError) as e:
+            self.logger.warning(f"Could not read device facts {self.facts_file}: {e}")
+            return None
+        if data.get("boot_id") != self.boot_id or data.get("hostname") != self.hostname:
+            return None
+        facts = data.get("facts", {})
+        if not {"distro", "virtualization", "cpu_temp_available"} <= facts.keys():
+            return None
+        self.logger.debug(f"Using cached device facts for boot {self.boot_id}")
+        return facts
+
+    def _save_device_facts(self, facts: Dict[str, Any]) -> None:
+        if self.facts_file is None or self.boot_id is None:
+            return
+        try:
+            atomic_write_text(self.facts_file, json.dumps({"boot_id": self.boot_id, "hostname": self.hostname, "facts": facts}, indent=2))
+        except OSError as e:
+            self.logger.warning(f"Could not write device facts {self.facts_file}: {e}")
+
     def _generate_discovery_payload(self) -> Dict[str, Dict[str, Any]]:
         # Build cmps dynamically based on configuration
         cmps: Dict[str, Dict[str, Any]] = {}
     
         if self.use_defaults:
-            cmps.update({
+            cmps.update(self._with_collector_availability("system", {
                 "cpu_usage": {
                     "p": "sensor",
                     "name": "CPU Usage",
@@ -171,11 +1921,11 @@ class SystemMonitor:
                     "icon": "mdi:clock-outline",
                     "value_template": "{{ value_json.uptime_seconds }}"
                 },
-            })
+            }))
 
             if self.cpu_temp_available:
                 self.logger.debug("CPU temperature sensor is available, adding to discovery")
-                cmps.update({
+                cmps.update(self._with_collector_availability("temperature", {
                     "cpu_temp": {
                         "p": "sensor",
                         "name": "CPU Temperature",
@@ -186,10 +1936,10 @@ class SystemMonitor:
                         "icon": "mdi:thermometer",
                         "value_template": "{{ value_json.cpu_temperature }}"
                     }
-                })
+                }))
             else:
                 self.logger.debug("CPU temperature sensor is not available, adding to discovery but disabled by default")
-                cmps.update({
+                cmps.update(self._with_collector_availability("temperature", {
                     "cpu_temp": {
                         "p": "sensor",
                         "name": "CPU Temperature",
@@ -201,18 +1951,46 @@ class SystemMonitor:
                         "value_template": "{{ value_json.cpu_temperature }}",
                         "enabled_by_default": False
                     }
-                })        
+                }))
+
+            if self.hwmon.selected:
+                self.logger.debug(f"Adding hwmon sensors: {[sensor.key for sensor in self.hwmon.selected]}")
+                cmps.update(self._with_collector_availability("temperature", self._generate_hwmon_sensors()))
         if self.mountpoints:
             self.logger.debug(f"Adding disk sensors for mountpoints: {self.mountpoints}")
-            cmps.update(self._generate_disk_sensors())
+            cmps.update(self._with_collector_availability("disks", self._generate_disk_sensors()))
+
+        if self.block_devices:
+            self.logger.debug(f"Adding block device sensors for: {self.block_devices}")
+            cmps.update(self._with_collector_availability("diskio", self._generate_block_device_sensors()))
 
         if self.interfaces:
             self.logger.debug(f"Adding network sensors for interfaces: {self.interfaces}")
-            cmps.update(self._generate_network_sensors())
+            cmps.update(self._with_collector_availability("network", self._generate_network_sensors()))
         
+        if self.use_defaults and self.sample_rate > 0:
+            self.logger.debug(f"Adding sample aggregate sensors at {self.sample_rate} Hz")
+            cmps.update(self._with_collector_availability("samples", self._generate_sample_sensors()))
+
         if self.services:
             self.logger.debug(f"Adding service sensors for: {self.services}")
-            cmps.update(self._generate_service_sensors())
+            cmps.update(self._with_collector_availability("services", self._generate_service_sensors()))
+
+        if self.processes:
+            self.logger.debug(f"Adding process sensors: top {self.top_processes}, watching {list(self.watch_processes)}")
+            cmps.update(self._with_collector_availability("processes", self._generate_process_sensors()))
+
+        if self.diagnostics:
+            cmps.update(self._with_collector_availability("diagnostics", self._generate_diagnostic_sensors()))
+
+        cmps["refresh"] = {
+            "p": "button",
+            "name": "Refresh",
+            "unique_id": f"{self.device_id}_refresh",
+            "command_topic": self.command_topic,
+            "payload_press": "refresh",
+            "icon": "mdi:refresh"
+        }
         
         discovery_payload = {
             "dev": {
@@ -230,16 +2008,33 @@ class SystemMonitor:
             },
             "cmps": cmps,
             "state_topic": self.state_topic,
-            "availability_topic": self.availability_topic,
+            "availability": [{"topic": self.availability_topic}],
             "qos": 1
         }
         return discovery_payload
 
-    def _generate_network_sensors(self) -> Dict[str, Dict[str, Any]]:
+    def _with_collector_availability(self, collector: str, components: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Mark components unavailable while their collector is stale, on top of device availability."""
+        state_topic = self._collector_state_topic(collector)
+        availability = [
+            {"topic": self.availability_topic},
+            {
+                "topic": state_topic,
+                "value_template": f"{{{{ 'offline' if '{collector}' in (value_json.unavailable | default([])) else 'online' }}}}"
+            }
+        ]
+        for component in components.values():
+            if state_topic != self.state_topic:
+                component["state_topic"] = state_topic
+            component["availability"] = availability
+            component["availability_mode"] = "all"
+        return components
+
+    def _generate_network_sensors(self, interfaces: list | None = None) -> Dict[str, Dict[str, Any]]:
         """Generate network sensors for each configured interface."""
         sensors: Dict[str, Dict[str, Any]] = {}
-        for iface in self.interfaces:
-            iface_safe = iface.replace('/', '_').replace('-', '_')
+        for iface in self.interfaces if interfaces is None else interfaces:
+            iface_safe = device_key(iface)
             if not iface_safe:
                 continue
 
@@ -286,7 +2081,7 @@ class SystemMonitor:
         """Generate binary sensors for each configured systemd service."""
         sensors: Dict[str, Dict[str, Any]] = {}
         for service in self.services:
-            service_safe = service.replace('.', '_').replace('-', '_').replace('@', '_')
+            service_safe = service_key(service)
             if not service_safe:
                 continue
 
@@ -300,17 +2095,129 @@ class SystemMonitor:
                 "payload_on": "active",
                 "payload_off": "inactive"
             }
-
+            sensors[f"service_{service_safe}_substate"] = {
+                "p": "sensor",
+                "name": f"Service {service} Sub-State",
+                "unique_id": f"{self.device_id}_service_{service_safe}_substate",
+                "icon": "mdi:cog-outline",
+                "value_template": f"{{{{ value_json.service_{service_safe}_substate }}}}",
+                "enabled_by_default": False
+            }
+            sensors[f"service_{service_safe}_restarts"] = {
+                "p": "sensor",
+                "name": f"Service {service} Restarts",
+                "unique_id": f"{self.device_id}_service_{service_safe}_restarts",
+                "state_class": "measurement",
+                "icon": "mdi:restart",
+                "value_template": f"{{{{ value_json.service_{service_safe}_restarts }}}}",
+                "enabled_by_default": False
+            }
+            sensors[f"service_{service_safe}_memory"] = {
+                "p": "sensor",
+                "name": f"Service {service} Memory",
+                "unique_id": f"{self.device_id}_service_{service_safe}_memory",
+                "unit_of_measurement": "MB",
+                "state_class": "measurement",
+                "icon": "mdi:memory",
+                "value_template": f"{{{{ value_json.service_{service_safe}_memory }}}}",
+                "enabled_by_default": False
+            }
+
+        return sensors
+    
+    def _generate_hwmon_sensors(self) -> Dict[str, Dict[str, Any]]:
+        """Generate temperature and fan sensors for each selected hwmon input."""
+        sensors: Dict[str, Dict[str, Any]] = {}
+        for sensor in self.hwmon.selected:
+            if sensor.kind == "temp":
+                sensors[f"hwmon_{sensor.key}"] = {
+                    "p": "sensor",
+                    "name": f"{sensor.chip} {sensor.label} Temperature",
+                    "unique_id": f"{self.device_id}_hwmon_{sensor.key}",
+                    "unit_of_measurement": "°C",
+                    "device_class": "temperature",
+                    "state_class": "measurement",
+                    "icon": "mdi:thermometer",
+                    "value_template": f"{{{{ value_json.hwmon_{sensor.key} }}}}"
+                }
+            else:
+                sensors[f"hwmon_{sensor.key}"] = {
+                    "p": "sensor",
+                    "name": f"{sensor.chip} {sensor.label} Fan",
+                    "unique_id": f"{self.device_id}_hwmon_{sensor.key}",
+                    "unit_of_measurement": "RPM",
+                    "state_class": "measurement",
+                    "icon": "mdi:fan",
+                    "value_template": f"{{{{ value_json.hwmon_{sensor.key} }}}}"
+                }
+        return sensors
+
+    def _generate_process_sensors(self) -> Dict[str, Dict[str, Any]]:
+        """Generate top-N process sensors and sensors for each process watch rule."""
+        sensors: Dict[str, Dict[str, Any]] = {}
+        state_topic = self._collector_state_topic("processes")
+        for rank in range(1, self.top_processes + 1):
+            sensors[f"proc_top_cpu_{rank}"] = {
+                "p": "sensor",
+                "name": f"Top CPU Process {rank}",
+                "unique_id": f"{self.device_id}_proc_top_cpu_{rank}",
+                "unit_of_measurement": "%",
+                "state_class": "measurement",
+                "icon": "mdi:chart-bar",
+                "value_template": f"{{{{ value_json.proc_top_cpu_{rank} }}}}",
+                "json_attributes_topic": state_topic,
+                "json_attributes_template": f"{{{{ {{'process': value_json.proc_top_cpu_{rank}_name}} | tojson }}}}"
+            }
+            sensors[f"proc_top_memory_{rank}"] = {
+                "p": "sensor",
+                "name": f"Top Memory Process {rank}",
+                "unique_id": f"{self.device_id}_proc_top_memory_{rank}",
+                "unit_of_measurement": "MB",
+                "state_class": "measurement",
+                "icon": "mdi:chart-bar",
+                "value_template": f"{{{{ value_json.proc_top_memory_{rank} }}}}",
+                "json_attributes_topic": state_topic,
+                "json_attributes_template": f"{{{{ {{'process': value_json.proc_top_memory_{rank}_name}} | tojson }}}}"
+            }
+
+        for watch_name in self.watch_processes:
+            watch_safe = name_key(watch_name)
+            if not watch_safe:
+                continue
+            sensors[f"proc_{watch_safe}_count"] = {
+                "p": "sensor",
+                "name": f"Process {watch_name} Count",
+                "unique_id": f"{self.device_id}_proc_{watch_safe}_count",
+                "state_class": "measurement",
+                "icon": "mdi:application-cog",
+                "value_template": f"{{{{ value_json.proc_{watch_safe}_count }}}}"
+            }
+            sensors[f"proc_{watch_safe}_cpu"] = {
+                "p": "sensor",
+                "name": f"Process {watch_name} CPU",
+                "unique_id": f"{self.device_id}_proc_{watch_safe}_cpu",
+                "unit_of_measurement": "%",
+                "state_class": "measurement",
+                "icon": "mdi:cpu-64-bit",
+                "value_template": f"{{{{ value_json.proc_{watch_safe}_cpu }}}}"
+            }
+            sensors[f"proc_{watch_safe}_memory"] = {
+                "p": "sensor",
+                "name": f"Process {watch_name} Memory",
+                "unique_id": f"{self.device_id}_proc_{watch_safe}_memory",
+                "unit_of_measurement": "MB",
+                "state_class": "measurement",
+                "icon": "mdi:memory",
+                "value_template": f"{{{{ value_json.proc_{watch_safe}_memory }}}}"
+            }
         return sensors
-    
-    def _generate_disk_sensors(self) -> Dict[str, Dict[str, Any]]:
+
+    def _generate_disk_sensors(self, mountpoints: list | None = None) -> Dict[str, Dict[str, Any]]:
         """Generate disk sensors for each configured mountpoint."""
         sensors = {}
-        for mountpoint in self.mountpoints:
+        for mountpoint in self.mountpoints if mountpoints is None else mountpoints:
             # Sanitize mountpoint name for unique_id
-            mount_safe = mountpoint.replace('/', '_').strip('_')
-            if not mount_safe:
-                mount_safe = "root"
+            mount_safe = mount_key(mountpoint)
             
             sensors[f"disk_usage_{mount_safe}"] = {
                 "p": "sensor",
@@ -341,163 +2248,1169 @@ class SystemMonitor:
             }
         return sensors
 
+    def _generate_diagnostic_sensors(self) -> Dict[str, Dict[str, Any]]:
+        """Generate diagnostic sensors for the monitor's own cycle timing, publish latency and memory."""
+        diagnostics = [
+            ("diag_cycle_duration", "Cycle Duration", "ms", "mdi:timer-outline"),
+            ("diag_publish_latency", "Publish Latency", "ms", "mdi:timer-sand"),
+            ("diag_outstanding_messages", "Outstanding Messages", None, "mdi:tray-full"),
+            ("diag_missed_ticks", "Missed Collector Ticks", None, "mdi:clock-alert-outline"),
+            ("diag_deadline_misses", "Collector Deadline Misses", None, "mdi:clock-alert"),
+            ("diag_rss", "Monitor Memory", "MiB", "mdi:memory"),
+        ]
+        for collector in self.collectors:
+            if collector.name != "diagnostics":
+                diagnostics.append((f"diag_{collector.name}_wall", f"Collector {collector.name.title()} Time", "ms", "mdi:timer-outline"))
+                diagnostics.append((f"diag_{collector.name}_cpu", f"Collector {collector.name.title()} CPU Time", "ms", "mdi:cpu-64-bit"))
+
+        sensors: Dict[str, Dict[str, Any]] = {}
+        for field, name, unit, icon in diagnostics:
+            sensors[field] = {
+                "p": "sensor",
+                "name": name,
+                "unique_id": f"{self.device_id}_{field}",
+                "entity_category": "diagnostic",
+                "state_class": "measurement",
+                "icon": icon,
+                "value_template": f"{{{{ value_json.{field} }}}}"
+            }
+            if unit is not None:
+                sensors[field]["unit_of_measurement"] = unit
+        return sensors
+
+    def _generate_sample_sensors(self, interfaces: list | None = None) -> Dict[str, Dict[str, Any]]:
+        """Generate windowed aggregate sensors for the high-frequency sampler, or only those of the given interfaces."""
+        sampled = [] if interfaces is not None else [("cpu_usage", "CPU Usage", "%", "mdi:cpu-64-bit"), ("memory_usage", "Memory Usage", "%", "mdi:memory")]
+        for iface in (self.interfaces or []) if interfaces is None else interfaces:
+            iface_safe = device_key(iface)
+            if not iface_safe:
+                continue
+            sampled.append((f"net_upload_{iface_safe}", f"Network {iface} Upload", "Mbps", "mdi:upload-network"))
+            sampled.append((f"net_download_{iface_safe}", f"Network {iface} Download", "Mbps", "mdi:download-network"))
+
+        sensors: Dict[str, Dict[str, Any]] = {}
+        for field, name, unit, icon in sampled:
+            for aggregate in SAMPLE_AGGREGATES:
+                sensors[f"{field}_{aggregate}"] = {
+                    "p": "sensor",
+                    "name": f"{name} {aggregate.title()}",
+                    "unique_id": f"{self.device_id}_{field}_{aggregate}",
+                    "unit_of_measurement": unit,
+                    "state_class": "measurement",
+                    "icon": icon,
+                    "value_template": f"{{{{ value_json.{field}_{aggregate} }}}}"
+                }
+        return sensors
+
+    def _generate_block_device_sensors(self) -> Dict[str, Dict[str, Any]]:
+        """Generate throughput and IOPS sensors for each configured block device."""
+        sensors: Dict[str, Dict[str, Any]] = {}
+        for device in self.block_devices:
+            device_safe = device_key(device)
+            if not device_safe:
+                continue
+
+            sensors[f"disk_read_{device_safe}"] = {
+                "p": "sensor",
+                "name": f"Disk {device} Read",
+                "unique_id": f"{self.device_id}_disk_read_{device_safe}",
+                "unit_of_measurement": "MB/s",
+                "device_class": "data_rate",
+                "state_class": "measurement",
+                "icon": "mdi:harddisk",
+                "value_template": f"{{{{ value_json.disk_read_{device_safe} }}}}"
+            }
+            sensors[f"disk_write_{device_safe}"] = {
+                "p": "sensor",
+                "name": f"Disk {device} Write",
+                "unique_id": f"{self.device_id}_disk_write_{device_safe}",
+                "unit_of_measurement": "MB/s",
+                "device_class": "data_rate",
+                "state_class": "measurement",
+                "icon": "mdi:harddisk",
+                "value_template": f"{{{{ value_json.disk_write_{device_safe} }}}}"
+            }
+            sensors[f"disk_read_iops_{device_safe}"] = {
+                "p": "sensor",
+                "name": f"Disk {device} Read IOPS",
+                "unique_id": f"{self.device_id}_disk_read_iops_{device_safe}",
+                "unit_of_measurement": "IOPS",
+                "state_class": "measurement",
+                "icon": "mdi:harddisk",
+                "value_template": f"{{{{ value_json.disk_read_iops_{device_safe} }}}}"
+            }
+            sensors[f"disk_write_iops_{device_safe}"] = {
+                "p": "sensor",
+                "name": f"Disk {device} Write IOPS",
+                "unique_id": f"{self.device_id}_disk_write_iops_{device_safe}",
+                "unit_of_measurement": "IOPS",
+                "state_class": "measurement",
+                "icon": "mdi:harddisk",
+                "value_template": f"{{{{ value_json.disk_write_iops_{device_safe} }}}}"
+            }
+        return sensors
+
+    def _cgroup_config_topic(self, cgroup: CgroupStats) -> str:
+        return f"{self.discovery_prefix}/device/{self.device_id}_cg_{cgroup.key}/config"
+
+    def _generate_cgroup_discovery_payload(self, cgroup: CgroupStats) -> Dict[str, Any]:
+        """Build a device discovery payload for one cgroup, linked to the host device."""
+        cgroup_device_id = f"{self.device_id}_cg_{cgroup.key}"
+        cmps: Dict[str, Dict[str, Any]] = {
+            "cpu_usage": {
+                "p": "sensor",
+                "name": "CPU Usage",
+                "unique_id": f"{cgroup_device_id}_cpu_usage",
+                "unit_of_measurement": "%",
+                "state_class": "measurement",
+                "icon": "mdi:cpu-64-bit",
+                "value_template": "{{ value_json.cpu_usage }}"
+            },
+            "memory_used": {
+                "p": "sensor",
+                "name": "Memory Used",
+                "unique_id": f"{cgroup_device_id}_memory_used",
+                "unit_of_measurement": "MB",
+                "state_class": "measurement",
+                "icon": "mdi:memory",
+                "value_template": "{{ value_json.memory_used }}"
+            },
+            "io_read": {
+                "p": "sensor",
+                "name": "IO Read",
+                "unique_id": f"{cgroup_device_id}_io_read",
+                "unit_of_measurement": "MB/s",
+                "device_class": "data_rate",
+                "state_class": "measurement",
+                "icon": "mdi:harddisk",
+                "value_template": "{{ value_json.io_read }}"
+            },
+            "io_write": {
+                "p": "sensor",
+                "name": "IO Write",
+                "unique_id": f"{cgroup_device_id}_io_write",
+                "unit_of_measurement": "MB/s",
+                "device_class": "data_rate",
+                "state_class": "measurement",
+                "icon": "mdi:harddisk",
+                "value_template": "{{ value_json.io_write }}"
+            },
+            "pids": {
+                "p": "sensor",
+                "name": "Processes",
+                "unique_id": f"{cgroup_device_id}_pids",
+                "state_class": "measurement",
+                "icon": "mdi:application-cog",
+                "value_template": "{{ value_json.pids }}"
+            },
+        }
+        return {
+            "dev": {
+                "identifiers": [cgroup_device_id],
+                "name": f"{self.hostname} {cgroup.name}",
+                "model": "cgroup",
+                "manufacturer": "System2MQTT",
+                "via_device": self.device_id
+            },
+            "o": self.discovery_payload["o"],
+            "cmps": cmps,
+            "state_topic": f"{self.base_topic}/cgroup/{cgroup.key}/state",
+            "availability": [{"topic": self.availability_topic}],
+            "qos": 1
+        }
+
+    def _hub_availability_topic(self, device: HubDevice) -> str:
+        return f"system2mqtt/{device.device_id}/availability"
+
+    def _hub_config_topic(self, device: HubDevice) -> str:
+        return f"{self.discovery_prefix}/device/{device.device_id}/config"
+
+    def _generate_hub_discovery_payload(self, device: HubDevice) -> Dict[str, Any]:
+        """Build a device discovery payload for one hub device, linked to the hub host."""
+        sensors = [
+            ("cpu_usage", "cpu_usage", "CPU Usage", "%", "mdi:cpu-64-bit"),
+            ("memory_usage", "memory_usage", "Memory Usage", "%", "mdi:memory"),
+            ("memory_used", "memory_used", "Memory Used", "GB", "mdi:memory"),
+            ("memory_total", "memory_total", "Memory Total", "GB", "mdi:memory"),
+            ("uptime", "uptime_seconds", "Uptime", "s", "mdi:clock-outline"),
+            ("net_upload", "net_upload", "Network Upload", "Mbps", "mdi:upload-network"),
+            ("net_download", "net_download", "Network Download", "Mbps", "mdi:download-network"),
+        ]
+        cmps: Dict[str, Dict[str, Any]] = {}
+        for component_id, field, name, unit, icon in sensors:
+            cmps[component_id] = {
+                "p": "sensor",
+                "name": name,
+                "unique_id": f"{device.device_id}_{component_id}",
+                "unit_of_measurement": unit,
+                "state_class": "total_increasing" if field == "uptime_seconds" else "measurement",
+                "icon": icon,
+                "value_template": f"{{{{ value_json.{field} }}}}"
+            }
+        return {
+            "dev": {
+                "identifiers": [device.device_id],
+                "name": device.name,
+                "model": "snapshot" if device.snapshot else "proc root",
+                "manufacturer": "System2MQTT",
+                "via_device": self.device_id
+            },
+            "o": self.discovery_payload["o"],
+            "cmps": cmps,
+            "state_topic": f"system2mqtt/{device.device_id}/state",
+            # Offline when either the hub or this device's source is
+            "availability": [{"topic": self.availability_topic}, {"topic": self._hub_availability_topic(device)}],
+            "availability_mode": "all",
+            "qos": 1
+        }
+
     def _get_component_platforms(self) -> Dict[str, str]:
         return {
             component_id: component.get("p", "sensor")
             for component_id, component in self.discovery_payload.get("cmps", {}).items()
         }
 
-    def _load_previous_components(self) -> Dict[str, str]:
+    def _load_state(self) -> Dict[str, Any]:
         if not self.state_file.exists():
             return {}
         try:
-            data = json.loads(self.state_file.read_text())
-            return data.get("components", {})
+            return json.loads(self.state_file.read_text())
         except (json.JSONDecodeError, OSError) as e:
             self.logger.warning(f"Could not read state file {self.state_file}: {e}")
             return {}
 
-    def _save_current_components(self, components: Dict[str, str]) -> None:
+    def _save_state(self, state: Dict[str, Any]) -> None:
         try:
-            self.state_file.parent.mkdir(parents=True, exist_ok=True)
-            self.state_file.write_text(json.dumps({"components": components}, indent=2))
+            atomic_write_text(self.state_file, json.dumps(state, indent=2))
         except OSError as e:
             self.logger.warning(f"Could not write state file {self.state_file}: {e}")
 
-    def _remove_components(self, components: Dict[str, str]) -> None:
-        if not components:
-            return
+    def _discovery_config(self, topic: str, generate: Callable[[], Dict[str, Any]]) -> tuple[bytes, str]:
+        """Return the serialized discovery config for topic and its hash, serializing only on a cache miss."""
+        cached = self.discovery_cache.get(topic)
+        if cached is None:
+            serialized = dump_json(generate())
+            cached = self.discovery_cache[topic] = (serialized, hashlib.sha256(serialized).hexdigest())
+        return cached
 
-        config_topic = f"{self.discovery_prefix}/device/{self.device_id}/config"
+    def _removal_payload(self, components: Dict[str, str]) -> bytes:
         removal_payload = {
             "dev": self.discovery_payload.get("dev", {}),
             "o": self.discovery_payload.get("o", {}),
             "cmps": {component_id: {"p": platform} for component_id, platform in components.items()},
             "state_topic": self.state_topic,
-            "availability_topic": self.availability_topic,
+            "availability": [{"topic": self.availability_topic}],
             "qos": 1
         }
         self.logger.info(f"Removing {len(components)} component(s) from discovery")
-        self.client.publish(config_topic, json.dumps(removal_payload), retain=True)
-        
-    def publish_discovery(self) -> None:
-        config_topic = f"{self.discovery_prefix}/device/{self.device_id}/config"
+        return dump_json(removal_payload)
+
+    def publish_discovery(self, force: bool = True, jitter: float = 0.0) -> None:
+        """Publish discovery configs, or only those changed since the last publish when not forced."""
         current_components = self._get_component_platforms()
-        previous_components = self._load_previous_components()
+        state = self._load_state()
+        previous_components = state.get("components", {})
+        published_hashes = state.get("discovery_hashes", {})
         removed_components = {
             component_id: platform
             for component_id, platform in previous_components.items()
             if component_id not in current_components
         }
 
+        configs = {self.config_topic: self._discovery_config(self.config_topic, lambda: self.discovery_payload)}
+        if self.cgroups:
+            for cgroup in list(self.cgroups.cgroups.values()):
+                topic = self._cgroup_config_topic(cgroup)
+                configs[topic] = self._discovery_config(topic, lambda: self._generate_cgroup_discovery_payload(cgroup))
+        if self.hub:
+            for device in list(self.hub.devices.values()):
+                topic = self._hub_config_topic(device)
+                configs[topic] = self._discovery_config(topic, lambda: self._generate_hub_discovery_payload(device))
+
+        messages: list[tuple[str, bytes]] = []
         if removed_components:
-            self._remove_components(removed_components)
+            messages.append((self.config_topic, self._removal_payload(removed_components)))
+        messages += [
+            (topic, serialized)
+            for topic, (serialized, digest) in configs.items()
+            if force or published_hashes.get(topic) != digest
+        ]
 
-        self.logger.info(f"Publishing discovery config to {config_topic}")
-        self.client.publish(config_topic, json.dumps(self.discovery_payload), retain=True)
-        self._save_current_components(current_components)
+        current_state = {"components": current_components, "discovery_hashes": {topic: digest for topic, (_, digest) in configs.items()}}
+        self.discovery_generation += 1
+        generation = self.discovery_generation
 
-    def publish_states(self) -> None:
-        state_payload: Dict[str, Any] = {}
-        if self.use_defaults:
-            # Use interval=0 to get non-blocking CPU measurement (already initialized in __init__)
-            cpu_usage = psutil.cpu_percent(interval=0)
-            memory = psutil.virtual_memory()
-            memory_usage = round(memory.percent, 1)
-            memory_used_gb = round(memory.used / (1024**3), 2)
-            memory_total_gb = round(memory.total / (1024**3), 2)
-            uptime_seconds = int(time.time() - psutil.boot_time())
-            cpu_temperature = self._get_cpu_temperature()
-            state_payload = state_payload | {
-                "cpu_usage": cpu_usage,
-                "memory_usage": memory_usage,
-                "memory_used": memory_used_gb,
-                "memory_total": memory_total_gb,
-                "uptime_seconds": uptime_seconds
-            }
-            if cpu_temperature is not None:
-                state_payload["cpu_temperature"] = cpu_temperature
-        if self.mountpoints:    
-            # Collect disk metrics for each mountpoint
-            for mountpoint in self.mountpoints:
-                try:
-                    disk = psutil.disk_usage(mountpoint)
-                    mount_safe = mountpoint.replace('/', '_').strip('_')
-                    if not mount_safe:
-                        mount_safe = "root"
-                    
-                    state_payload[f"disk_usage_{mount_safe}"] = round(disk.percent, 1)
-                    state_payload[f"disk_used_{mount_safe}"] = round(disk.used / (1024**3), 2)
-                    state_payload[f"disk_total_{mount_safe}"] = round(disk.total / (1024**3), 2)
-                except (OSError, ValueError) as e:
-                    self.logger.warning(f"Could not read disk usage for {mountpoint}: {e}")
+        def save_state() -> None:
+            # A later publish (e.g. from on_connect while a jittered one is still sending) owns the state file
+            if current_state != state and generation == self.discovery_generation:
+                self._save_state(current_state)
 
-        if self.interfaces:
-            net_io = psutil.net_io_counters(pernic=True)
-            current_time = time.time()
-            time_delta = None
-            if self.prev_net_time is not None:
-                time_delta = current_time - self.prev_net_time
+        if messages:
+            self.logger.info(f"Publishing {len(messages)} discovery config(s)" + (f" over {jitter:g}s" if jitter > 0 else ""))
+            self._send_discovery(messages, jitter, save_state)
+        else:
+            self.logger.info("Discovery configs unchanged since last publish, not resending")
+            save_state()
 
-            for iface in self.interfaces:
-                if iface not in net_io:
-                    self.logger.warning(f"Network interface not found: {iface}")
-                    continue
+    def _send_discovery(self, messages: list[tuple[str, bytes]], jitter: float, on_sent: Callable[[], None]) -> None:
+        """Publish discovery messages, then call on_sent so hashes are only recorded once their configs went out."""
+        if jitter <= 0:
+            for topic, payload in messages:
+                self.client.publish(topic, payload, retain=True)
+            on_sent()
+            return
 
-                iface_safe = iface.replace('/', '_').replace('-', '_')
-                current = net_io[iface]
-                prev = self.prev_net_io.get(iface)
+        # Spread re-announcements over a random window so every device answering the same
+        # Home Assistant birth message doesn't hit the broker at once; order is preserved
+        delays = sorted(random.uniform(0, jitter) for _ in messages)
 
-                net_upload_mbps = 0.0
-                net_download_mbps = 0.0
-                if prev is not None and time_delta and time_delta > 0:
-                    bytes_sent_delta = current.bytes_sent - prev.bytes_sent
-                    bytes_recv_delta = current.bytes_recv - prev.bytes_recv
-                    net_upload_mbps = round((bytes_sent_delta / time_delta) * 8 / (1024**2), 2)
-                    net_download_mbps = round((bytes_recv_delta / time_delta) * 8 / (1024**2), 2)
+        def announce() -> None:
+            start = time.monotonic()
+            for delay, (topic, payload) in zip(delays, messages):
+                time.sleep(max(0.0, start + delay - time.monotonic()))
+                self.client.publish(topic, payload, retain=True)
+            on_sent()
 
-                state_payload[f"net_upload_{iface_safe}"] = net_upload_mbps
-                state_payload[f"net_download_{iface_safe}"] = net_download_mbps
-                state_payload[f"net_sent_{iface_safe}"] = round(current.bytes_sent / (1024**3), 2)
-                state_payload[f"net_recv_{iface_safe}"] = round(current.bytes_recv / (1024**3), 2)
+        threading.Thread(target=announce, name="discovery-announce", daemon=True).start()
 
-                self.prev_net_io[iface] = current
+    def _build_collectors(self) -> list["CollectorSchedule"]:
+        collect_functions = {
+            "system": self._collect_system if self.use_defaults else None,
+            "temperature": self._collect_temperature if self.use_defaults else None,
+            "disks": self._collect_disks if self.mountpoint_patterns else None,
+            "network": self._collect_network if self.interface_patterns else None,
+            "diskio": self._collect_block_devices if self.block_devices else None,
+            "services": self._collect_services if self.services else None,
+            "processes": self._collect_processes if self.processes else None,
+            "samples": self.sampler.collect if self.sampler else None,
+            "cgroups": self._collect_cgroups if self.cgroups else None,
+            "hub": self._collect_hub if self.hub else None,
+            "diagnostics": self._collect_diagnostics if self.diagnostics else None,
+        }
+        intervals = dict(self.collector_intervals)
+        if self.hub:
+            # The hub interval is per device; the collector runs once per slice
+            intervals["hub"] = self.hub_interval / self.hub.slices
+        return [
+            CollectorSchedule(name, collect, intervals.get(name, self.update_interval))
+            for name, collect in collect_functions.items()
+            if collect is not None
+        ]
 
-            self.prev_net_time = current_time
-        
-        if self.services:
-            for service in self.services:
-                try:
-                    result = subprocess.run(
-                        ["systemctl", "is-active", service],
-                        capture_output=True,
-                        text=True,
-                        timeout=5
-                    )
-                    service_safe = service.replace('.', '_').replace('-', '_').replace('@', '_')
-                    # systemctl returns "active", "inactive", "failed", etc.
-                    status = result.stdout.strip()
-                    state_payload[f"service_{service_safe}"] = status
-                except (subprocess.TimeoutExpired, subprocess.SubprocessError, FileNotFoundError) as e:
-                    self.logger.warning(f"Could not check status for service {service}: {e}")
-                    service_safe = service.replace('.', '_').replace('-', '_').replace('@', '_')
-                    state_payload[f"service_{service_safe}"] = "unknown"
-        
+    def _collect_system(self) -> Dict[str, Any]:
+        # Non-blocking CPU measurement (baseline already taken in __init__)
+        cpu_usage = self.backend.cpu_percent()
+        memory_percent, memory_used, memory_total = self.backend.memory()
+        return {
+            "cpu_usage": cpu_usage,
+            "memory_usage": round(memory_percent, 1),
+            "memory_used": round(memory_used / (1024**3), 2),
+            "memory_total": round(memory_total / (1024**3), 2),
+            "uptime_seconds": int(self.backend.uptime())
+        }
+
+    def _collect_temperature(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        cpu_temperature = self._get_cpu_temperature()
+        if cpu_temperature is not None:
+            state["cpu_temperature"] = cpu_temperature
+        for key, value in self.hwmon.read_selected().items():
+            state[f"hwmon_{key}"] = value
+        return state
+
+    def _collect_disks(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        for mountpoint in self.mountpoints:
+            try:
+                disk = psutil.disk_usage(mountpoint)
+                usage_key, used_key, total_key = state_keys(mount_key(mountpoint), DISK_FIELDS)
+                state[usage_key] = round(disk.percent, 1)
+                state[used_key] = round(disk.used / (1024**3), 2)
+                state[total_key] = round(disk.total / (1024**3), 2)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Could not read disk usage for {mountpoint}: {e}")
+        return state
+
+    def _collect_network(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        net_io = self.backend.net_counters(self.interfaces)
+        now = time.monotonic()
+
+        for iface in self.interfaces:
+            if iface not in net_io:
+                self.logger.warning(f"Network interface not found: {iface}")
+                # Rebaseline when it comes back instead of computing a rate across the gap
+                self.rates.forget(f"net:{iface}:sent")
+                self.rates.forget(f"net:{iface}:recv")
+                continue
+
+            upload_key, download_key, sent_key, recv_key = state_keys(device_key(iface), NETWORK_FIELDS)
+            bytes_sent, bytes_recv = net_io[iface]
+            upload_rate = self.rates.update(f"net:{iface}:sent", bytes_sent, now)
+            download_rate = self.rates.update(f"net:{iface}:recv", bytes_recv, now)
+
+            state[upload_key] = round((upload_rate or 0.0) * 8 / (1024**2), 2)
+            state[download_key] = round((download_rate or 0.0) * 8 / (1024**2), 2)
+            state[sent_key] = round(bytes_sent / (1024**3), 2)
+            state[recv_key] = round(bytes_recv / (1024**3), 2)
+        return state
+
+    def _collect_block_devices(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        disk_io = self.backend.disk_counters(self.block_devices)
+        now = time.monotonic()
+
+        for device in self.block_devices:
+            counter_keys = [f"diskio:{device}:{counter}" for counter in ("read", "write", "read_ops", "write_ops")]
+            if device not in disk_io:
+                self.logger.warning(f"Block device not found: {device}")
+                for key in counter_keys:
+                    self.rates.forget(key)
+                continue
+
+            read_key, write_key, read_iops_key, write_iops_key = state_keys(device_key(device), BLOCK_DEVICE_FIELDS)
+            read_rate, write_rate, read_ops_rate, write_ops_rate = (
+                self.rates.update(key, value, now) or 0.0
+                for key, value in zip(counter_keys, disk_io[device])
+            )
+            state[read_key] = round(read_rate / (1024**2), 2)
+            state[write_key] = round(write_rate / (1024**2), 2)
+            state[read_iops_key] = round(read_ops_rate, 1)
+            state[write_iops_key] = round(write_ops_rate, 1)
+        return state
+
+    def _collect_services(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        for service, status in self._get_service_states().items():
+            active_key, substate_key, restarts_key, memory_key = state_keys(service_key(service), SERVICE_FIELDS)
+            state[active_key] = status["active_state"]
+            if "sub_state" in status:
+                state[substate_key] = status["sub_state"]
+            if "restarts" in status:
+                state[restarts_key] = status["restarts"]
+            if "memory" in status:
+                state[memory_key] = status["memory"]
+        return state
+
+    def _collect_processes(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        self.processes.update()
+        for rank, entry in enumerate(self.processes.top(self.top_processes, lambda entry: entry.cpu_percent), start=1):
+            cpu_key, cpu_name_key, _, _ = state_keys(str(rank), TOP_PROCESS_FIELDS)
+            state[cpu_key] = round(entry.cpu_percent, 1)
+            state[cpu_name_key] = f"{entry.name} ({entry.pid})"
+        for rank, entry in enumerate(self.processes.top(self.top_processes, lambda entry: entry.rss), start=1):
+            _, _, memory_key, memory_name_key = state_keys(str(rank), TOP_PROCESS_FIELDS)
+            state[memory_key] = round(entry.rss / (1024**2), 1)
+            state[memory_name_key] = f"{entry.name} ({entry.pid})"
+        for watch_name, pattern in self.watch_processes.items():
+            count_key, cpu_key, memory_key = state_keys(name_key(watch_name), WATCH_PROCESS_FIELDS)
+            matches = self.processes.matching(pattern)
+            state[count_key] = len(matches)
+            state[cpu_key] = round(sum(entry.cpu_percent for entry in matches), 1)
+            state[memory_key] = round(sum(entry.rss for entry in matches) / (1024**2), 1)
+        return state
+
+    def _collect_diagnostics(self) -> Dict[str, Any]:
+        # Timings are those of the last completed cycle; this collector runs alongside the others
+        latency = self.metrics.publish_latency()
+        state: Dict[str, Any] = {
+            "diag_cycle_duration": round(self.metrics.cycle_duration * 1000, 1),
+            "diag_outstanding_messages": self.metrics.outstanding(),
+            "diag_missed_ticks": sum(collector.missed_ticks for collector in self.collectors),
+            "diag_deadline_misses": self.metrics.deadline_misses,
+            "diag_rss": round(self.metrics.rss() / (1024**2), 1),
+        }
+        # No latency before the first acknowledgement; Home Assistant rejects null for a measurement
+        if latency is not None:
+            state["diag_publish_latency"] = round(latency * 1000, 1)
+        for name, wall in list(self.metrics.collector_wall.items()):
+            if name != "diagnostics":
+                state[f"diag_{name}_wall"] = round(wall * 1000, 1)
+                state[f"diag_{name}_cpu"] = round(self.metrics.collector_cpu[name] * 1000, 1)
+        return state
+
+    def _render_metrics(self) -> str:
+        """Render the self-instrumentation in Prometheus text exposition format."""
+        lines = [
+            "# HELP system2mqtt_collector_duration_seconds Wall time of the last run of each collector.",
+            "# TYPE system2mqtt_collector_duration_seconds gauge",
+        ]
+        lines += [f'system2mqtt_collector_duration_seconds{{collector="{name}"}} {wall}' for name, wall in list(self.metrics.collector_wall.items())]
+        lines += [
+            "# HELP system2mqtt_collector_cpu_seconds CPU time of the last run of each collector.",
+            "# TYPE system2mqtt_collector_cpu_seconds gauge",
+        ]
+        lines += [f'system2mqtt_collector_cpu_seconds{{collector="{name}"}} {cpu}' for name, cpu in list(self.metrics.collector_cpu.items())]
+        lines += [
+            "# HELP system2mqtt_collector_missed_ticks_total Collector ticks skipped because a cycle ran late.",
+            "# TYPE system2mqtt_collector_missed_ticks_total counter",
+        ]
+        lines += [f'system2mqtt_collector_missed_ticks_total{{collector="{collector.name}"}} {collector.missed_ticks}' for collector in self.collectors]
+        latency = self.metrics.publish_latency()
+        lines += [
+            "# HELP system2mqtt_cycle_duration_seconds Duration of the last collect and publish cycle.",
+            "# TYPE system2mqtt_cycle_duration_seconds gauge",
+            f"system2mqtt_cycle_duration_seconds {self.metrics.cycle_duration}",
+            "# HELP system2mqtt_collector_deadline_misses_total Collector runs that missed the collector timeout.",
+            "# TYPE system2mqtt_collector_deadline_misses_total counter",
+            f"system2mqtt_collector_deadline_misses_total {self.metrics.deadline_misses}",
+            "# HELP system2mqtt_publish_latency_seconds Mean time from publish to PUBACK (QoS 1) or socket write (QoS 0) over the last 100 messages.",
+            "# TYPE system2mqtt_publish_latency_seconds gauge",
+            f"system2mqtt_publish_latency_seconds {latency if latency is not None else 'NaN'}",
+            "# HELP system2mqtt_outstanding_messages Published messages not yet acknowledged or written.",
+            "# TYPE system2mqtt_outstanding_messages gauge",
+            f"system2mqtt_outstanding_messages {self.metrics.outstanding()}",
+            "# HELP system2mqtt_spooled_messages State messages spooled while disconnected.",
+            "# TYPE system2mqtt_spooled_messages gauge",
+            f"system2mqtt_spooled_messages {len(self.spool)}",
+            "# HELP system2mqtt_publish_queue_depth State messages waiting for an inflight slot.",
+            "# TYPE system2mqtt_publish_queue_depth gauge",
+            f"system2mqtt_publish_queue_depth {len(self.publisher)}",
+            "# HELP system2mqtt_publish_superseded_total Queued state messages replaced by a newer one for the same topic.",
+            "# TYPE system2mqtt_publish_superseded_total counter",
+            f"system2mqtt_publish_superseded_total {self.publisher.superseded}",
+            "# HELP system2mqtt_resident_memory_bytes Resident set size of the monitor.",
+            "# TYPE system2mqtt_resident_memory_bytes gauge",
+            f"system2mqtt_resident_memory_bytes {self.metrics.rss()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def _start_metrics_server(self) -> None:
+        try:
+            self.metrics_server = ThreadingHTTPServer((self.metrics_address, self.metrics_port), MetricsRequestHandler)
+        except OSError as e:
+            self.logger.error(f"Could not start metrics endpoint on {self.metrics_address}:{self.metrics_port}: {e}")
+            return
+        self.metrics_server.daemon_threads = True
+        self.metrics_server.render_metrics = self._render_metrics
+        threading.Thread(target=self.metrics_server.serve_forever, name="metrics", daemon=True).start()
+        self.logger.info(f"Serving Prometheus metrics on http://{self.metrics_address}:{self.metrics_port}/metrics")
+
+    def _collect_cgroups(self) -> Dict[str, Dict[str, Any]]:
+        added, removed = self.cgroups.refresh()
+        for cgroup in removed:
+            self.logger.info(f"Cgroup {cgroup.path} disappeared, removing its device")
+            self.client.publish(self._cgroup_config_topic(cgroup), "", retain=True)
+            self.discovery_cache.pop(self._cgroup_config_topic(cgroup), None)
+            for counter in ("cpu", "read", "write"):
+                self.rates.forget(f"cgroup:{cgroup.key}:{counter}")
+        for cgroup in added:
+            self.logger.info(f"Found cgroup {cgroup.path}, publishing its device")
+            topic = self._cgroup_config_topic(cgroup)
+            self.client.publish(topic, self._discovery_config(topic, lambda: self._generate_cgroup_discovery_payload(cgroup))[0], retain=True)
+
+        now = time.monotonic()
+        states: Dict[str, Dict[str, Any]] = {}
+        for key, (cpu_usage, memory, io_read, io_write, pids) in self.cgroups.read().items():
+            state: Dict[str, Any] = {}
+            if cpu_usage is not None:
+                # usage_usec is CPU time summed over all CPUs; report it as a share of the whole host like cpu_usage
+                cpu_rate = self.rates.update(f"cgroup:{key}:cpu", cpu_usage, now) or 0.0
+                state["cpu_usage"] = round(cpu_rate / 1e6 * 100 / self.cpu_count, 1)
+            if memory is not None:
+                state["memory_used"] = round(memory / (1024**2), 1)
+            state["io_read"] = round((self.rates.update(f"cgroup:{key}:read", io_read, now) or 0.0) / (1024**2), 2)
+            state["io_write"] = round((self.rates.update(f"cgroup:{key}:write", io_write, now) or 0.0) / (1024**2), 2)
+            if pids is not None:
+                state["pids"] = pids
+            states[key] = state
+        return states
+
+    def _collect_hub(self) -> Dict[str, Dict[str, Any] | None]:
+        if self.hub.run % self.hub.slices == 0:
+            added, removed = self.hub.refresh()
+            for device in removed:
+                self.logger.info(f"Hub device {device.name} ({device.path}) disappeared, removing it")
+                self.pending_removals.update((self._hub_config_topic(device), self._hub_availability_topic(device)))
+                self.discovery_cache.pop(self._hub_config_topic(device), None)
+                for counter in ("cpu", "sent", "recv"):
+                    self.rates.forget(f"hub:{device.device_id}:{counter}")
+            if self.connected.is_set():
+                self._publish_pending_removals()
+            for device in added:
+                self.logger.info(f"Found hub device {device.name} at {device.path}, publishing it")
+                topic = self._hub_config_topic(device)
+                # Back before its removal was sent; the new config replaces the old one instead
+                self.pending_removals.difference_update((topic, self._hub_availability_topic(device)))
+                self.client.publish(topic, self._discovery_config(topic, lambda: self._generate_hub_discovery_payload(device))[0], retain=True)
+
+        stale_after = HUB_STALE_INTERVALS * self.hub_interval
+        states: Dict[str, Dict[str, Any] | None] = {}
+        for device in self.hub.next_slice():
+            try:
+                states[device.device_id] = device.read(self.rates, stale_after)
+            except (OSError, ValueError, IndexError) as e:
+                if device.available is not False:
+                    self.logger.warning(f"Could not read hub device {device.name} from {device.path}: {e}")
+                device.close()
+                states[device.device_id] = None
+        return states
+
+    def _publish_hub_states(self, states: Dict[str, Dict[str, Any] | None]) -> None:
+        devices = {device.device_id: device for device in self.hub.devices.values()}
+        for device_id, state in states.items():
+            device = devices.get(device_id)
+            if device is not None and device.available != (state is not None):
+                device.available = state is not None
+                # on_connect republishes every device's availability, so a flip while offline isn't lost
+                if self.connected.is_set():
+                    self._publish_hub_availability(device)
+            if state is not None:
+                self._publish_state(f"system2mqtt/{device_id}/state", dump_json(state))
+
+    def _publish_hub_availability(self, device: HubDevice) -> None:
+        self.client.publish(self._hub_availability_topic(device), "online" if device.available else "offline", qos=self.qos, retain=True)
+
+    def _publish_pending_removals(self) -> None:
+        for topic in list(self.pending_removals):
+            self.pending_removals.discard(topic)
+            self.client.publish(topic, "", qos=self.qos, retain=True)
+
+    def _publish_cgroup_states(self, states: Dict[str, Dict[str, Any]]) -> None:
+        for key, state in states.items():
+            self._publish_state(f"{self.base_topic}/cgroup/{key}/state", dump_json(state))
+
+    def _resolve_targets(self, patterns: list, excludes: list, available: list[str]) -> list[str]:
+        # Literal entries are always kept (and warned about when missing); patterns match what exists now
+        resolved = [entry for entry in patterns if not is_target_pattern(entry)]
+        pattern_entries = [entry for entry in patterns if is_target_pattern(entry)]
+        if pattern_entries:
+            resolved += [name for name in available if name not in resolved and matches_target(name, pattern_entries)]
+        return [name for name in resolved if not matches_target(name, excludes)]
+
+    def _resolve_mountpoints(self) -> list[str]:
+        available = self.mount_watcher.mountpoints() if self.mount_watcher else []
+        return self._resolve_targets(self.mountpoint_patterns, self.exclude_mountpoints, available)
+
+    def _resolve_interfaces(self) -> list[str]:
+        available = self.interface_watcher.interfaces() if self.interface_watcher else []
+        return self._resolve_targets(self.interface_patterns, self.exclude_interfaces, available)
+
+    def _refresh_targets(self) -> None:
+        """Re-resolve mountpoint/interface patterns after a change and push only the delta to discovery."""
+        mounts_changed = self.mount_watcher is not None and self.mount_watcher.changed()
+        interfaces_changed = self.interface_watcher is not None and self.interface_watcher.changed()
+        if not (mounts_changed or interfaces_changed):
+            return
+
+        cmps = self.discovery_payload["cmps"]
+        updated = False
+        if mounts_changed:
+            mountpoints = self._resolve_mountpoints()
+            added = [mountpoint for mountpoint in mountpoints if mountpoint not in self.mountpoints]
+            removed = [mountpoint for mountpoint in self.mountpoints if mountpoint not in mountpoints]
+            if added or removed:
+                self.logger.info(f"Mountpoints changed: added {added}, removed {removed}")
+                for component_id in self._generate_disk_sensors(removed):
+                    cmps.pop(component_id, None)
+                cmps.update(self._with_collector_availability("disks", self._generate_disk_sensors(added)))
+                self.mountpoints = mountpoints
+                updated = True
+
+        if interfaces_changed:
+            interfaces = self._resolve_interfaces()
+            added = [iface for iface in interfaces if iface not in self.interfaces]
+            removed = [iface for iface in self.interfaces if iface not in interfaces]
+            if added or removed:
+                self.logger.info(f"Network interfaces changed: added {added}, removed {removed}")
+                for component_id in self._generate_network_sensors(removed):
+                    cmps.pop(component_id, None)
+                for iface in removed:
+                    self.rates.forget(f"net:{iface}:sent")
+                    self.rates.forget(f"net:{iface}:recv")
+                cmps.update(self._with_collector_availability("network", self._generate_network_sensors(added)))
+                if self.sampler:
+                    for component_id in self._generate_sample_sensors(removed):
+                        cmps.pop(component_id, None)
+                    cmps.update(self._with_collector_availability("samples", self._generate_sample_sensors(added)))
+                    self.sampler.set_interfaces(interfaces)
+                self.interfaces = interfaces
+                updated = True
+
+        if not updated:
+            return
+        self.discovery_cache.pop(self.config_topic, None)
+        # publish_discovery diffs against the state file, so only removed components are retracted
+        # and only the changed host config is resent; when offline, on_connect publishes the updated payload
+        if self.connected.is_set():
+            self.publish_discovery(force=False)
+
+    def publish_states(self, force: bool = False) -> None:
+        """Run every due collector (or all of them when forced) and publish the merged state."""
+        start = time.perf_counter()
+        try:
+            self._collect_and_publish(force)
+        finally:
+            self.metrics.cycle_duration = time.perf_counter() - start
+
+    def _run_collector(self, collector: CollectorSchedule) -> Dict[str, Any]:
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            return collector.collect()
+        finally:
+            self.metrics.record_collector(collector.name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def _submit_collector(self, collector: CollectorSchedule) -> Future:
+        if not self.profiling:
+            return self.executor.submit(self._run_collector, collector)
+        # cProfile only sees the thread it runs in, so profiled cycles collect inline
+        future: Future = Future()
+        try:
+            future.set_result(self._run_collector(collector))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _collect_and_publish(self, force: bool) -> None:
+        self._refresh_targets()
+        now = time.monotonic()
+        requested = self._take_requested_collectors(now)
+        refreshed: set[str] = set()
+        submitted: Dict[Future, CollectorSchedule] = {}
+        for collector in self.collectors:
+            due = force or collector.is_due(now)
+            # A refresh right after the scheduled run would only repeat it
+            refresh = collector.name in requested and (collector.last_run is None or now - collector.last_run >= self.refresh_min_interval)
+            if not due and not refresh:
+                continue
+            if collector.pending is not None and not collector.pending.done():
+                # Still stuck in a previous run; don't tie up another worker with it
+                self.logger.warning(f"Collector {collector.name} is still running from a previous cycle, skipping")
+                self.stale_collectors.add(collector.name)
+            else:
+                collector.pending = self._submit_collector(collector)
+                collector.last_run = now
+                submitted[collector.pending] = collector
+                if refresh:
+                    refreshed.add(collector.name)
+            if due:
+                collector.advance(now)
+        if refreshed:
+            self.logger.info(f"Refreshing {', '.join(sorted(refreshed))} on request")
+        elif requested:
+            self.logger.debug(f"Skipping refresh of {', '.join(sorted(requested))}, already collected within {self.refresh_min_interval}s")
+        with self.refresh_lock:
+            # Scheduled runs already satisfy requests that are still waiting out the rate limit
+            self.requested_collectors.difference_update(collector.name for collector in submitted.values())
+
+        done, not_done = wait(submitted, timeout=self.collector_timeout)
+        with self.publish_lock:
+            self._publish_collected(submitted, done, not_done, refreshed)
+
+    def _open_history(self, max_bytes: int) -> MetricHistory | None:
+        if max_bytes <= 0 or self.state_file is None or self.boot_id is None:
+            return None
+        path = self.state_file.with_name("history.bin")
+        try:
+            history = MetricHistory(path, max_bytes, self.boot_id)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Could not open metric history {path}: {e}")
+            return None
+        self.logger.debug(f"Keeping up to {history.capacity} history records in {path}")
+        return history
+
+    def _record_history(self, collected: set[str]) -> None:
+        """Append counter readings taken since the last call and the system gauges to the history ring."""
+        # Snapshot the readings: a collector that missed its deadline may still be adding to them
+        samples = [
+            (key, value, timestamp, True)
+            for key, (value, timestamp) in list(self.rates.samples.items())
+            if timestamp > self.history_recorded_until and key.startswith(("net:", "diskio:"))
+        ]
+        now = time.monotonic()
+        if "system" in collected:
+            system = self.collector_states.get("system", {})
+            samples.extend((key, system[key], now, False) for key in ("cpu_usage", "memory_usage") if key in system)
+        self.history_recorded_until = now
+        if samples:
+            self.history.record(samples)
+
+    def _queue_history_query(self, payload: bytes) -> None:
+        # Scanning the ring takes a moment; keep the network loop responsive with a single worker
+        with self.history_lock:
+            if self.history_waiting is not None:
+                self.logger.debug("History request replaced by a newer one before it was answered")
+            self.history_waiting = payload
+            if self.history_thread is not None:
+                return
+            self.history_thread = threading.Thread(target=self._answer_history_queries, name="history-query", daemon=True)
+            self.history_thread.start()
+
+    def _answer_history_queries(self) -> None:
+        while True:
+            with self.history_lock:
+                payload, self.history_waiting = self.history_waiting, None
+                if payload is None:
+                    # Cleared under the lock, so a request arriving now starts a new worker
+                    self.history_thread = None
+                    return
+            try:
+                self._answer_history_query(payload)
+            except Exception as e:
+                # Keep the worker alive, or no later request would be answered
+                self.logger.error(f"History request failed: {e}")
+
+    def _answer_history_query(self, payload: bytes) -> None:
+        """Publish rolled-up history for a JSON request like {"id": 1, "minutes": 30, "step": 60, "keys": ["net:*"]}."""
+        try:
+            request = json.loads(payload or b"{}")
+            minutes = float(request.get("minutes", 60))
+            patterns = [str(pattern) for pattern in request.get("keys", [])]
+            step = max(float(request.get("step", 0)), minutes * 60 / HISTORY_MAX_POINTS, 1.0)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.logger.warning(f"Ignoring malformed history request on {self.history_request_topic}: {e}")
+            return
+        since = time.time() - minutes * 60
+        response = {"id": request.get("id"), "from": round(since, 3), "step": step, "series": self.history.query(since, step, patterns)}
+        self.metrics.published(self.client.publish(self.history_response_topic, dump_json(response), qos=1).mid)
+
+    def _take_requested_collectors(self, now: float) -> set[str]:
+        with self.refresh_lock:
+            if not self.requested_collectors or now - self.last_refresh < self.refresh_min_interval:
+                return set()
+            requested, self.requested_collectors = self.requested_collectors, set()
+            self.last_refresh = now
+        return requested
+
+    def _publish_collected(self, submitted: Dict[Future, CollectorSchedule], done: set[Future], not_done: set[Future], refreshed: set[str]) -> None:
+        for future in done:
+            collector = submitted[future]
+            collector.pending = None
+            try:
+                self.collector_states[collector.name] = future.result()
+                self.stale_collectors.discard(collector.name)
+                if collector.name == "cgroups":
+                    self._publish_cgroup_states(self.collector_states[collector.name])
+                elif collector.name == "hub":
+                    self._publish_hub_states(self.collector_states[collector.name])
+            except Exception as e:
+                self.logger.error(f"Collector {collector.name} failed: {e}")
+                self.stale_collectors.add(collector.name)
+        for future in not_done:
+            collector = submitted[future]
+            self.logger.warning(f"Collector {collector.name} missed its {self.collector_timeout}s deadline, marking unavailable")
+            self.metrics.deadline_misses += 1
+            self.stale_collectors.add(collector.name)
+
+        if self.history:
+            self._record_history({submitted[future].name for future in done})
+
+        if submitted and all(collector.name in DEVICE_COLLECTORS for collector in submitted.values()):
+            # Only cgroup or hub devices ran (the hub runs once per slice); the host state hasn't changed
+            return
+
+        if self.publish_mode == "changes":
+            self._publish_changed_states(refreshed)
+            return
+
+        state_payload = self._merged_state()
         self.logger.debug(f"Publishing state: {state_payload}")
-        self.client.publish(self.state_topic, json.dumps(state_payload))
+        self._publish_state(self.state_topic, dump_json(state_payload))
+
+    def _merged_state(self) -> Dict[str, Any]:
+        state_payload: Dict[str, Any] = {}
+        for collector in self.collectors:
+            if collector.name not in DEVICE_COLLECTORS:
+                state_payload.update(self.collector_states.get(collector.name, {}))
+        if self.stale_collectors:
+            state_payload["unavailable"] = sorted(self.stale_collectors)
+        return state_payload
+
+    def _on_service_events(self, changes: Dict[str, Dict[str, str]]) -> None:
+        """Merge coalesced unit state changes into the services state and publish them right away."""
+        self.logger.debug(f"Service state changes from D-Bus: {changes}")
+        with self.publish_lock:
+            state = dict(self.collector_states.get("services", {}))
+            for service, status in changes.items():
+                active_key, substate_key, _, _ = state_keys(service_key(service), SERVICE_FIELDS)
+                if "active_state" in status:
+                    state[active_key] = status["active_state"]
+                if "sub_state" in status:
+                    state[substate_key] = status["sub_state"]
+            self.collector_states["services"] = state
+
+            if self.publish_mode == "changes":
+                payload = dict(state)
+                if "services" in self.stale_collectors:
+                    payload["unavailable"] = ["services"]
+                if self._publish_state(self._collector_state_topic("services"), dump_json(payload), retain=True):
+                    self.last_published_states["services"] = payload
+            else:
+                self._publish_state(self.state_topic, dump_json(self._merged_state()))
+
+    def _on_service_events_status(self, listening: bool) -> None:
+        # Poll at the normal rate whenever signals can't be received
+        interval = self.collector_intervals["services"] if listening else self.service_poll_interval
+        for collector in self.collectors:
+            if collector.name == "services" and collector.interval != interval:
+                collector.interval = interval
+                collector.next_due = min(collector.next_due, time.monotonic() + interval)
+
+    def _publish_changed_states(self, refreshed: set[str]) -> None:
+        """Publish each collector's retained state topic only when a field moved past its deadband, or was refreshed on request."""
+        self.cycles_since_full_refresh += 1
+        full_refresh = self.cycles_since_full_refresh >= self.full_refresh_cycles
+        if full_refresh:
+            self.cycles_since_full_refresh = 0
+
+        for collector in self.collectors:
+            if collector.name in DEVICE_COLLECTORS:
+                continue
+            collector_payload = dict(self.collector_states.get(collector.name, {}))
+            if collector.name in self.stale_collectors:
+                collector_payload["unavailable"] = [collector.name]
+
+            last_payload = self.last_published_states.get(collector.name)
+            if not full_refresh and collector.name not in refreshed and last_payload is not None and not self._state_changed(last_payload, collector_payload):
+                continue
+
+            self.logger.debug(f"Publishing {collector.name} state: {collector_payload}")
+            if self._publish_state(self._collector_state_topic(collector.name), dump_json(collector_payload), retain=True):
+                # A spooled payload never reaches the retained topic, so it must still count as unpublished
+                self.last_published_states[collector.name] = collector_payload
+
+    def _publish_state(self, topic: str, payload: bytes, retain: bool = False) -> bool:
+        """Submit a state message; returns False when it was spooled for replay instead."""
+        if not self.connected.is_set():
+            # Keep the sample in the bounded spool instead of paho's unbounded queue
+            self.spool.append(topic, payload, time.time())
+            return False
+        self.publisher.submit(topic, payload, self.qos, retain)
+        return True
+
+    def _start_replay(self) -> None:
+        if self.replay_thread is not None and self.replay_thread.is_alive():
+            return
+        self.replay_thread = threading.Thread(target=self._replay_spool, name="spool-replay", daemon=True)
+        self.replay_thread.start()
+
+    def _replay_spool(self) -> None:
+        replayed = self.spool.replay(self._publish_replayed, self.spool_replay_rate, self.connected.is_set)
+        if replayed:
+            self.logger.info(f"Replayed {replayed} spooled state message(s) to {self.replay_topic} ({self.spool.dropped} dropped while offline)")
+        self.spool.dropped = 0
+
+    def _publish_replayed(self, timestamp: float, topic: str, payload: bytes) -> None:
+        # Replayed samples go to their own topic with their original timestamp so they
+        # don't overwrite the current state in Home Assistant
+        message = self.client.publish(self.replay_topic, b"".join((b'{"timestamp":', dump_json(timestamp), b',"topic":', dump_json(topic), b',"state":', payload, b"}")), qos=1)
+        self.metrics.published(message.mid)
+
+    def _state_changed(self, previous: Dict[str, Any], current: Dict[str, Any]) -> bool:
+        if previous.keys() != current.keys():
+            return True
+        for key, value in current.items():
+            last_value = previous[key]
+            if value == last_value:
+                continue
+            deadband = self._get_deadband(key)
+            if deadband is None or not isinstance(value, (int, float)) or not isinstance(last_value, (int, float)):
+                return True
+            threshold, relative = deadband
+            if relative:
+                threshold = abs(last_value) * threshold / 100
+            if abs(value - last_value) > threshold:
+                return True
+        return False
+
+    def _get_deadband(self, key: str) -> tuple[float, bool] | None:
+        # Longest matching family prefix wins, e.g. "net_upload" over "net"
+        if key not in self.deadband_cache:
+            if len(self.deadband_cache) >= KEY_CACHE_SIZE:
+                self.deadband_cache.clear()
+            families = [family for family in self.deadbands if key.startswith(family)]
+            self.deadband_cache[key] = self.deadbands[max(families, key=len)] if families else None
+        return self.deadband_cache[key]
+
+    def _collector_state_topic(self, collector: str) -> str:
+        if self.publish_mode == "changes":
+            return f"{self.state_topic}/{collector}"
+        return self.state_topic
+
+    def _seconds_until_next_collection(self) -> float:
+        if not self.collectors:
+            return float(self.update_interval)
+        next_due = min(collector.next_due for collector in self.collectors)
+        with self.refresh_lock:
+            if self.requested_collectors:
+                next_due = min(next_due, self.last_refresh + self.refresh_min_interval)
+        return max(0.0, next_due - time.monotonic())
+
+    def _wait_for_next_collection(self) -> None:
+        """Sleep until a collector is due, waking early for refresh commands."""
+        while True:
+            timeout = self._seconds_until_next_collection()
+            if timeout <= 0:
+                return
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def _handle_command(self, payload: bytes) -> None:
+        """Queue an on-demand refresh: "refresh" for every collector, or "refresh <collector>[,<collector>...]"."""
+        words = payload.decode(errors="replace").replace(",", " ").split()
+        if not words or words[0] != "refresh":
+            self.logger.warning(f"Ignoring unknown command on {self.command_topic}: {payload[:64]!r}")
+            return
+        collectors = {collector.name for collector in self.collectors}
+        names = set(words[1:]) or collectors
+        if names - collectors:
+            self.logger.warning(f"Ignoring refresh of unknown or disabled collectors: {', '.join(sorted(names - collectors))}")
+        with self.refresh_lock:
+            self.requested_collectors.update(names & collectors)
+        self.wakeup.set()
+
+    def _get_service_states(self) -> Dict[str, Dict[str, Any]]:
+        """Query all configured services with a single batched systemctl call."""
+        try:
+            result = subprocess.run(
+                ["systemctl", "show", f"--property={','.join(SERVICE_PROPERTIES)}", "--", *self.services],
+                capture_output=True,
+                text=True,
+                timeout=5
+            )
+        except (subprocess.TimeoutExpired, subprocess.SubprocessError, FileNotFoundError) as e:
+            self.logger.warning(f"Batched service query failed, falling back to systemctl is-active: {e}")
+            return self._get_service_states_fallback()
+
+        # systemctl prints one block per unit, separated by blank lines, in argument order
+        blocks = [block for block in result.stdout.split("\n\n") if block.strip()]
+        if result.returncode != 0 or len(blocks) != len(self.services):
+            self.logger.warning(f"Unexpected output from systemctl show (code {result.returncode}), falling back to systemctl is-active")
+            return self._get_service_states_fallback()
+
+        states: Dict[str, Dict[str, Any]] = {}
+        for service, block in zip(self.services, blocks):
+            properties = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+            status: Dict[str, Any] = {
+                "active_state": properties.get("ActiveState") or "unknown",
+                "sub_state": properties.get("SubState") or "unknown",
+            }
+            if properties.get("NRestarts", "").isdigit():
+                status["restarts"] = int(properties["NRestarts"])
+            memory_bytes = self._get_service_memory(properties)
+            if memory_bytes is not None:
+                status["memory"] = round(memory_bytes / (1024**2), 1)
+            states[service] = status
+        return states
+
+    def _get_service_memory(self, properties: Dict[str, str]) -> int | None:
+        # Prefer the unit's cgroup accounting, fall back to the main PID's resident set
+        memory_current = properties.get("MemoryCurrent", "")
+        if memory_current.isdigit() and int(memory_current) != UINT64_MAX:
+            return int(memory_current)
+        main_pid = properties.get("MainPID", "")
+        if main_pid.isdigit() and int(main_pid) > 0:
+            try:
+                with open(f"/proc/{main_pid}/statm", "r", encoding="utf-8") as handle:
+                    return int(handle.read().split()[1]) * PAGE_SIZE
+            except (OSError, IndexError, ValueError):
+                return None
+        return None
+
+    def _get_service_states_fallback(self) -> Dict[str, Dict[str, Any]]:
+        states: Dict[str, Dict[str, Any]] = {}
+        for service in self.services:
+            try:
+                result = subprocess.run(
+                    ["systemctl", "is-active", service],
+                    capture_output=True,
+                    text=True,
+                    timeout=5
+                )
+                # systemctl returns "active", "inactive", "failed", etc.
+                states[service] = {"active_state": result.stdout.strip()}
+            except (subprocess.TimeoutExpired, subprocess.SubprocessError, FileNotFoundError) as e:
+                self.logger.warning(f"Could not check status for service {service}: {e}")
+                states[service] = {"active_state": "unknown"}
+        return states
+
+    def _profile_cycles(self) -> None:
+        """Run the first cycles under cProfile and dump the stats next to the state file."""
+        profile_path = self.state_file.parent / "profile.pstats"
+        profiler = cProfile.Profile()
+        self.profiling = True
+        for cycle in range(self.profile_cycles):
+            profiler.enable()
+            try:
+                self.publish_states()
+            finally:
+                profiler.disable()
+            if cycle < self.profile_cycles - 1:
+                self._wait_for_next_collection()
+        self.profiling = False
+        try:
+            profiler.dump_stats(profile_path)
+            self.logger.info(f"Wrote profile of {self.profile_cycles} cycle(s) to {profile_path}")
+        except OSError as e:
+            self.logger.warning(f"Could not write profile {profile_path}: {e}")
+        stats = io.StringIO()
+        pstats.Stats(profiler, stream=stats).sort_stats("cumulative").print_stats(25)
+        self.logger.info(f"Profile of {self.profile_cycles} cycle(s):\n{stats.getvalue()}")
 
     def on_connect(self, client: mqtt.Client, userdata: Any, flags: Dict[str, int], rc: int) -> None:
         if rc == 0:
             self.logger.info("Connected to MQTT broker")
+            self.reconnect_failures = 0
+            self.publisher.reset_inflight()
             self.client.subscribe("homeassistant/status")
+            self.client.subscribe(self.command_topic)
+            if self.history:
+                self.client.subscribe(self.history_request_topic)
+            if self.hub:
+                # Clear removed devices first, so a device that came back keeps the config published next
+                self._publish_pending_removals()
             self.publish_discovery()
+            self.client.publish(self.availability_topic, "online", retain=True)
+            self.connected.set()
+            if self.hub:
+                # Availability flips while disconnected were never sent; set after connected so none are missed
+                for device in list(self.hub.devices.values()):
+                    if device.available is not None:
+                        self._publish_hub_availability(device)
+            # States that were waiting when the connection dropped are still the latest per topic
+            self.publisher.drain()
+            if len(self.spool):
+                self._start_replay()
         else:
             self.logger.error(f"Failed to connect to MQTT broker: code {rc}")
 
+    def on_publish(self, client: mqtt.Client, userdata: Any, mid: int) -> None:
+        self.metrics.acknowledged(mid)
+        self.publisher.acknowledged(mid)
+
+    def on_disconnect(self, client: mqtt.Client, userdata: Any, rc: int) -> None:
+        self.connected.clear()
+        if rc != 0:
+            self.logger.warning(f"Disconnected from MQTT broker (code {rc}), spooling states until reconnected")
+
     def on_message(self, client: mqtt.Client, userdata: Any, msg: mqtt.MQTTMessage) -> None:
         if msg.topic == "homeassistant/status" and msg.payload == b"online":
-            self.logger.info("Home Assistant restarted, resending discovery config")
-            self.publish_discovery()
+            # Retained configs that match what we last published are redelivered by the broker already
+            self.logger.info("Home Assistant restarted, resending changed discovery configs")
+            self.publish_discovery(force=False, jitter=self.discovery_jitter)
+        elif msg.topic == self.command_topic:
+            self._handle_command(msg.payload)
+        elif msg.topic == self.history_request_topic and self.history:
+            self._queue_history_query(msg.payload)
+
+    def _network_loop(self) -> None:
+        """Drive paho's network loop, reconnecting with capped exponential backoff and full jitter."""
+        while not self.stopping.is_set():
+            try:
+                self.client.reconnect()
+                while self.client.loop(timeout=1.0) == mqtt.MQTT_ERR_SUCCESS:
+                    pass
+            except (OSError, mqtt.WebsocketConnectionError) as e:
+                self.logger.warning(f"Could not connect to MQTT broker at {self.mqtt_host}:{self.mqtt_port}: {e}")
+            if self.stopping.is_set():
+                return
+            # Full jitter keeps many monitors from reconnecting in lockstep after a broker restart
+            self.reconnect_failures += 1
+            delay = random.uniform(0, min(self.reconnect_max_delay, self.reconnect_min_delay * 2 ** self.reconnect_failures))
+            self.logger.info(f"Reconnecting to MQTT broker in {delay:.1f}s")
+            self.stopping.wait(delay)
 
     def run(self) -> None:
         try:
@@ -506,25 +3419,55 @@ class SystemMonitor:
             self.client.username_pw_set(self.mqtt_user, self.mqtt_pass)
             self.client.on_connect = self.on_connect
             self.client.on_message = self.on_message
-            
+            self.client.on_disconnect = self.on_disconnect
+            self.client.on_publish = self.on_publish
+            self.client.max_inflight_messages_set(self.publisher.max_inflight)
+            self.client.max_queued_messages_set(self.spool.max_samples)
+            self.publisher.client = self.client
+
             self.logger.info(f"Connecting to MQTT broker at {self.mqtt_host}:{self.mqtt_port}")
-            self.client.connect(self.mqtt_host, self.mqtt_port, 60)
-            self.client.loop_start()
-            time.sleep(2)
-            self.client.publish(self.availability_topic, "online", retain=True)
-            
+            self.client.connect_async(self.mqtt_host, self.mqtt_port, 60)
+            self.network_thread = threading.Thread(target=self._network_loop, name="mqtt-network", daemon=True)
+            self.network_thread.start()
+            if self.sampler:
+                self.sampler.start()
+            if self.metrics_port:
+                self._start_metrics_server()
+            if self.service_events:
+                self.service_events.start()
+            # Availability and discovery are sent from on_connect; publish the first state as soon as it ran
+            if not self.connected.wait(timeout=self.update_interval):
+                self.logger.warning("Not connected to MQTT broker yet, spooling states until connected")
+
             self.logger.info(f"Starting monitoring loop with {self.update_interval}s interval")
+            if self.profile_cycles > 0:
+                self._profile_cycles()
+                self._wait_for_next_collection()
             while True:
                 self.publish_states()
-                time.sleep(self.update_interval)
+                self._wait_for_next_collection()
         except KeyboardInterrupt:
             self.logger.info("Stopping System2MQTT...")
         except Exception as e:
             self.logger.error(f"Error in main loop: {e}")
         finally:
             self.client.publish(self.availability_topic, "offline", retain=True)
-            self.client.loop_stop()
             self.client.disconnect()
+            self.stopping.set()
+            if self.network_thread:
+                # Lets the network loop write the offline message and DISCONNECT before exiting
+                self.network_thread.join(timeout=5)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            if self.sampler:
+                self.sampler.stop()
+            if self.metrics_server:
+                self.metrics_server.shutdown()
+            if self.service_events:
+                self.service_events.stop()
+            if self.history:
+                self.history.close()
+            if self.hub:
+                self.hub.close()
             self.logger.info("Disconnected from MQTT broker")
 
 if __name__ == "__main__":
@@ -539,12 +3482,76 @@ if __name__ == "__main__":
     parser.add_argument("--user", default="", help="MQTT username")
     parser.add_argument("--pass", dest="password", default="", help="MQTT password")
     parser.add_argument("--interval", type=int, default=30, help="Update interval in seconds (default: 30)")
-    parser.add_argument("--mountpoints", type=str, nargs="+", default=[], help="Disk mountpoints to monitor (default: /)")
-    parser.add_argument("--interfaces", type=str, nargs="+", default=[], help="Network interfaces to monitor (e.g. eth0 wlan0)")
+    parser.add_argument("--mountpoints", type=str, nargs="+", default=[], help="Disk mountpoints to monitor, as paths, shell patterns or re:REGEX (e.g. / '/mnt/*')")
+    parser.add_argument("--exclude-mountpoints", type=str, nargs="+", default=[], help="Mountpoints to skip, as shell patterns or re:REGEX")
+    parser.add_argument("--interfaces", type=str, nargs="+", default=[], help="Network interfaces to monitor, as names, shell patterns or re:REGEX (e.g. eth0 'wg*' 're:veth.*')")
+    parser.add_argument("--exclude-interfaces", type=str, nargs="+", default=[], help="Network interfaces to skip, as shell patterns or re:REGEX")
+    parser.add_argument("--block-devices", type=str, nargs="+", default=[], help="Block devices to monitor for throughput and IOPS (e.g. sda nvme0n1)")
+    parser.add_argument("--hwmon-sensors", type=str, nargs="+", default=[], metavar="CHIP[:LABEL]", help="hwmon temperature/fan inputs to publish as shell patterns (e.g. coretemp:Package* nct6775:fan*)")
+    parser.add_argument("--cgroups", type=str, nargs="+", default=[], metavar="PATTERN", help="cgroup v2 paths to publish as separate devices, as globs relative to /sys/fs/cgroup (e.g. 'system.slice/docker-*.scope' 'machine.slice/*')")
+    parser.add_argument("--cgroup-rescan-interval", type=float, default=60, help="Maximum seconds between full rescans of the cgroup tree (default: 60)")
+    parser.add_argument("--hub-devices", type=str, nargs="+", default=[], metavar="[NAME=]PATH", help="Other hosts to publish as their own devices, from /proc roots (directories) or JSON snapshot files (a proc root's CPU and memory come from its init's cgroup v2); globs name devices after the file or the directory holding proc (e.g. '/srv/guests/*/proc' '/run/agents/*.json' web1=/var/lib/machines/web1/proc)")
+    parser.add_argument("--top-processes", type=int, default=0, help="Publish the top N processes by CPU and by memory (default: 0, disabled)")
+    parser.add_argument("--watch-processes", type=str, nargs="+", default=[], metavar="NAME=PATTERN", help="Publish count, CPU and memory of processes whose name matches a shell pattern, or whose command line matches a regex given as re:REGEX (e.g. web=nginx* backup=re:backup\\.py)")
     parser.add_argument("--services", type=str, nargs="+", default=[], help="Systemd services to monitor (e.g. nginx.service docker.service)")
+    parser.add_argument("--service-events", action="store_true", help="Publish service state changes from systemd D-Bus signals as they happen, polling only as a consistency check (needs jeepney)")
+    parser.add_argument("--dbus-bus", choices=["system", "session"], default="system", help="Bus to listen on for service events (default: system)")
+    parser.add_argument("--service-event-window", type=float, default=0.5, help="Seconds over which bursts of service state changes are coalesced (default: 0.5)")
     parser.add_argument("--state-file", default="/var/lib/system2mqtt/state.json", help="Path to discovery state file")
     parser.add_argument("--use-defaults", action="store_true", default=True, help="Enable defaults")
+    parser.add_argument("--discovery-jitter", type=float, default=2.0, help="Spread discovery re-announcements after a Home Assistant restart over up to this many seconds (default: 2, 0 disables)")
+    parser.add_argument("--collector-timeout", type=float, default=10, help="Seconds a collector may run before its sensors are marked unavailable (default: 10)")
+    parser.add_argument("--publish-mode", choices=["full", "changes"], default="full", help="Publish the full state every cycle, or only collectors whose values changed beyond their deadband (default: full)")
+    parser.add_argument("--deadbands", type=str, nargs="+", default=[], metavar="FAMILY=THRESHOLD", help="Deadbands for change-only publishing, absolute or relative with a % suffix (e.g. cpu_usage=2 net_upload=10%%)")
+    parser.add_argument("--full-refresh-cycles", type=int, default=10, help="Republish every collector state after this many cycles in change-only mode (default: 10)")
+    parser.add_argument("--backend", choices=["auto", "proc", "psutil"], default="auto", help="Metric source for CPU, memory, uptime and network: direct /proc readers or psutil (default: auto, /proc when available)")
+    parser.add_argument("--sample-rate", type=float, default=0, help="Sample CPU, memory and network at this rate in Hz and publish min/max/mean/p95 per window (default: 0, disabled)")
+    parser.add_argument("--rate-smoothing", type=float, default=0.0, help="EWMA weight of the previous rate for network and block device rates, 0 to 1 (default: 0, disabled)")
+    parser.add_argument("--spool-size", type=int, default=1000, help="Maximum number of state messages spooled while the broker is unreachable (default: 1000)")
+    parser.add_argument("--spool-policy", choices=["drop-oldest", "drop-newest", "downsample"], default="drop-oldest", help="What to drop when the spool is full; downsample needs the in-memory spool (default: drop-oldest)")
+    parser.add_argument("--spool-to-disk", action="store_true", help="Spool to append-only segment files next to the state file instead of memory")
+    parser.add_argument("--spool-disk-bytes", type=int, default=10 * 1024**2, help="Maximum size of the on-disk spool in bytes (default: 10 MiB)")
+    parser.add_argument("--spool-replay-rate", type=float, default=10, help="Spooled messages replayed per second after reconnecting (default: 10)")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0, help="QoS for state messages; with 1 the publish latency covers the broker's PUBACK (default: 0)")
+    parser.add_argument("--diagnostics", action="store_true", help="Publish diagnostic sensors for the monitor's own cycle time, collector times, publish latency and memory")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve the monitor's own metrics in Prometheus format on this port at /metrics (default: 0, disabled)")
+    parser.add_argument("--metrics-address", default="127.0.0.1", help="Address for the metrics endpoint (default: 127.0.0.1)")
+    parser.add_argument("--profile-cycles", type=int, default=0, help="Profile the first N cycles with cProfile and dump the stats next to the state file (default: 0, disabled)")
+    parser.add_argument("--max-inflight", type=int, default=10, help="Maximum state messages handed to the broker connection but not yet acknowledged (default: 10)")
+    parser.add_argument("--reconnect-min-delay", type=float, default=1, help="Base delay in seconds for reconnect backoff (default: 1)")
+    parser.add_argument("--reconnect-max-delay", type=float, default=120, help="Maximum delay in seconds between reconnect attempts (default: 120)")
+    parser.add_argument("--refresh-min-interval", type=float, default=5, help="Minimum seconds between on-demand refreshes from the command topic; requests in between are merged (default: 5)")
+    parser.add_argument("--history-size", type=int, default=1024**2, help="Bytes for the ring file of counter baselines and metric history next to the state file; 0 disables it (default: 1 MiB)")
+    parser.add_argument("--collector-intervals", type=str, nargs="+", default=[], metavar="NAME=SECONDS", help=f"Per-collector update intervals overriding --interval (collectors: {', '.join(COLLECTOR_NAMES)})")
     args = parser.parse_args()
+
+    collector_intervals: Dict[str, int] = {}
+    for entry in args.collector_intervals:
+        name, _, seconds = entry.partition("=")
+        if name not in COLLECTOR_NAMES or not seconds.isdigit() or int(seconds) <= 0:
+            parser.error(f"invalid collector interval '{entry}', expected NAME=SECONDS with NAME one of: {', '.join(COLLECTOR_NAMES)}")
+        collector_intervals[name] = int(seconds)
+
+    watch_processes: Dict[str, str] = {}
+    for entry in args.watch_processes:
+        name, _, pattern = entry.partition("=")
+        if not name or not pattern:
+            parser.error(f"invalid process watch rule '{entry}', expected NAME=PATTERN")
+        watch_processes[name] = pattern
+
+    if not 0 <= args.rate_smoothing < 1:
+        parser.error("--rate-smoothing must be at least 0 and below 1")
+    if args.spool_to_disk and args.spool_policy == "downsample":
+        parser.error("--spool-policy downsample needs the in-memory spool, not --spool-to-disk")
+
+    deadbands: Dict[str, tuple[float, bool]] = {}
+    for entry in args.deadbands:
+        family, _, threshold = entry.partition("=")
+        relative = threshold.endswith("%")
+        try:
+            deadbands[family] = (float(threshold.rstrip("%")), relative)
+        except ValueError:
+            parser.error(f"invalid deadband '{entry}', expected FAMILY=THRESHOLD or FAMILY=PERCENT%")
     
     monitor = SystemMonitor(
         mqtt_host=args.host,
@@ -556,6 +3563,42 @@ if __name__ == "__main__":
         mountpoints=args.mountpoints,
         interfaces=args.interfaces,
         services=args.services,
-        state_file=args.state_file
+        state_file=args.state_file,
+        collector_intervals=collector_intervals,
+        collector_timeout=args.collector_timeout,
+        publish_mode=args.publish_mode,
+        deadbands=deadbands,
+        full_refresh_cycles=args.full_refresh_cycles,
+        backend=args.backend,
+        sample_rate=args.sample_rate,
+        block_devices=args.block_devices,
+        rate_smoothing=args.rate_smoothing,
+        spool_size=args.spool_size,
+        spool_policy=args.spool_policy,
+        spool_to_disk=args.spool_to_disk,
+        spool_disk_bytes=args.spool_disk_bytes,
+        spool_replay_rate=args.spool_replay_rate,
+        hwmon_sensors=args.hwmon_sensors,
+        cgroups=args.cgroups,
+        cgroup_rescan_interval=args.cgroup_rescan_interval,
+        top_processes=args.top_processes,
+        watch_processes=watch_processes,
+        exclude_mountpoints=args.exclude_mountpoints,
+        exclude_interfaces=args.exclude_interfaces,
+        discovery_jitter=args.discovery_jitter,
+        diagnostics=args.diagnostics,
+        metrics_port=args.metrics_port,
+        metrics_address=args.metrics_address,
+        profile_cycles=args.profile_cycles,
+        qos=args.qos,
+        service_events=args.service_events,
+        dbus_bus=args.dbus_bus,
+        service_event_window=args.service_event_window,
+        max_inflight=args.max_inflight,
+        reconnect_min_delay=args.reconnect_min_delay,
+        reconnect_max_delay=args.reconnect_max_delay,
+        refresh_min_interval=args.refresh_min_interval,
+        history_bytes=args.history_size,
+        hub_devices=args.hub_devices
     )
     monitor.run()
\ No newline at end of file